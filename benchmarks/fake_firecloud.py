@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the FireCloud entity endpoints used by the export and import scripts, for benchmarking."""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeFireCloud:
+    """Synthetic data tables served over list_entity_types, get_entities_query and upload_entities.
+
+    Rows are generated from their index when a page is requested rather than stored, so tables of any size cost
+    no memory. Uploaded rows are counted but not stored. Every response can be delayed by latency (+ up to jitter)
+    seconds, requests beyond throttle_rps per second are answered with 429, a fraction error_rate of requests fail
+    with 503, and uploads larger than max_payload_bytes are rejected with 413.
+    """
+
+    def __init__(self, tables, latency=0.0, jitter=0.0, throttle_rps=None, error_rate=0.0, max_payload_bytes=None, seed=0):
+        # {entity type: (row count, attribute names)}
+        self.tables = tables
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rps = throttle_rps
+        self.error_rate = error_rate
+        self.max_payload_bytes = max_payload_bytes
+        self.uploaded_rows = {}
+        self.request_counts = {}
+        self._random = random.Random(seed)
+        self._tokens = float(throttle_rps or 0)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def count(self, endpoint, status_code):
+        with self._lock:
+            key = f"{endpoint} {status_code}"
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def injected_failure(self):
+        """Return the status code of a throttled or failed request, or None if the request should succeed."""
+        with self._lock:
+            if self.throttle_rps:
+                now = time.monotonic()
+                self._tokens = min(float(self.throttle_rps), self._tokens + (now - self._last_refill) * self.throttle_rps)
+                self._last_refill = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+            if self._random.random() < self.error_rate:
+                return 503
+            delay = self.latency + self._random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+        return None
+
+    def entity_types(self):
+        return {entity_type: {"count": count, "idName": f"{entity_type}_id", "attributeNames": list(attribute_names)}
+                for entity_type, (count, attribute_names) in self.tables.items()}
+
+    def entity_page(self, entity_type, page, page_size, fields=None):
+        count, attribute_names = self.tables[entity_type]
+        if fields:
+            attribute_names = [name for name in attribute_names if name in fields.split(",")]
+        results = []
+        # names are zero-padded so index order is the same as the ascending name order the API sorts by
+        for index in range((page - 1) * page_size, min(count, page * page_size)):
+            attributes = {name: f"{name}_value_{index}" for name in attribute_names}
+            results.append({"entityType": entity_type, "name": f"{entity_type}_{index:09d}", "attributes": attributes})
+        return {"parameters": {"page": page, "pageSize": page_size},
+                "resultMetadata": {"unfilteredCount": count, "filteredCount": count,
+                                   "filteredPageCount": -(-count // page_size)},
+                "results": results}
+
+    def upload(self, entities):
+        header, _, rows = entities.partition("\n")
+        entity_type = header.split("\t")[0].partition(":")[2][:-len("_id")]
+        with self._lock:
+            self.uploaded_rows[entity_type] = self.uploaded_rows.get(entity_type, 0) + rows.count("\n")
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.request_counts), "uploaded_rows": dict(self.uploaded_rows)}
+
+    def reset_stats(self):
+        with self._lock:
+            self.request_counts = {}
+            self.uploaded_rows = {}
+
+    def make_server(self, host="127.0.0.1", port=0):
+        """Return an HTTP server for this stand-in; FISS's root url should be set to http://host:port/api/."""
+        return ThreadingHTTPServer((host, port), make_handler(self))
+
+
+def make_handler(fake):
+    class FakeFireCloudHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, endpoint, status_code, body=None, headers=None):
+            # the stand-in's own _stats and _reset endpoints aren't counted
+            if not endpoint.startswith("_"):
+                fake.count(endpoint, status_code)
+            data = json.dumps(body).encode("utf-8") if body is not None else b""
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def fail(self, endpoint, status_code):
+            headers = {"Retry-After": "1"} if status_code == 429 else None
+            self.respond(endpoint, status_code, {"message": f"injected {status_code}"}, headers)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if url.path == "/_stats":
+                return self.respond("_stats", 200, fake.stats())
+            if parts in (["health"], ["status"]):
+                return self.respond(parts[0], 200, {})
+
+            # api/workspaces/<namespace>/<workspace>/entities[Query/<entity type>]
+            if len(parts) == 5 and parts[4] == "entities":
+                endpoint = "list_entity_types"
+                status_code = fake.injected_failure()
+                if status_code:
+                    return self.fail(endpoint, status_code)
+                return self.respond(endpoint, 200, fake.entity_types())
+            if len(parts) == 6 and parts[4] == "entityQuery":
+                endpoint = "get_entities_query"
+                if parts[5] not in fake.tables:
+                    return self.respond(endpoint, 404, {"message": f"{parts[5]} does not exist"})
+                status_code = fake.injected_failure()
+                if status_code:
+                    return self.fail(endpoint, status_code)
+                query = parse_qs(url.query)
+                page = fake.entity_page(parts[5], int(query["page"][0]), int(query["pageSize"][0]),
+                                        query.get("fields", [None])[0])
+                return self.respond(endpoint, 200, page)
+
+            self.respond("unknown", 404, {"message": f"{url.path} is not implemented by the stand-in"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if url.path == "/_reset":
+                fake.reset_stats()
+                return self.respond("_reset", 200, {})
+
+            if len(parts) == 5 and parts[4] in ("importEntities", "flexibleImportEntities"):
+                endpoint = "upload_entities"
+                if fake.max_payload_bytes and len(body) > fake.max_payload_bytes:
+                    return self.fail(endpoint, 413)
+                status_code = fake.injected_failure()
+                if status_code:
+                    return self.fail(endpoint, status_code)
+                fake.upload(parse_qs(body.decode("utf-8"))["entities"][0])
+                return self.respond(endpoint, 200)
+
+            self.respond("unknown", 404, {"message": f"{url.path} is not implemented by the stand-in"})
+
+    return FakeFireCloudHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the FireCloud entity endpoints.")
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('-e', '--entity_type', type=str, default="sample", help='Entity type of the synthetic table.')
+    parser.add_argument('-r', '--rows', type=int, default=100000, help='Number of rows in the synthetic table.')
+    parser.add_argument('-c', '--columns', type=int, default=10, help='Number of attribute columns in the synthetic table.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra random seconds to delay every response.')
+    parser.add_argument('--throttle_rps', type=float, help='Answer requests beyond this many per second with 429.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests to fail with 503.')
+    parser.add_argument('--max_payload_bytes', type=int, help='Reject uploads larger than this with 413.')
+
+    args = parser.parse_args()
+    columns = [f"attribute_{column}" for column in range(args.columns)]
+    fake = FakeFireCloud({args.entity_type: (args.rows, columns)}, args.latency, args.jitter, args.throttle_rps,
+                         args.error_rate, args.max_payload_bytes)
+    server = fake.make_server(port=args.port)
+    print(f"Serving the FireCloud stand-in at http://127.0.0.1:{server.server_address[1]}/api/")
+    server.serve_forever()
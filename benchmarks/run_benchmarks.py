@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Benchmark export_large_tsv and import_large_tsv against a local FireCloud stand-in on synthetic tables."""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+import requests
+
+from fake_firecloud import FakeFireCloud
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+PROJECT = "benchmark-project"
+WORKSPACE = "benchmark-workspace"
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of the current process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def serve(tables, server_options, port_queue):
+    """Run the stand-in server until the process is terminated."""
+    server = FakeFireCloud(tables, **server_options).make_server()
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def run_operation(root_url, operation, options, result_queue, verbose):
+    """Run one export or upload in this process against the stand-in and put its timings in result_queue.
+
+    If the operation raises, a result with the error is put in result_queue instead, so the harness doesn't wait
+    for a result that never comes.
+    """
+    try:
+        result_queue.put(time_operation(root_url, operation, options, verbose))
+    except BaseException as e:
+        result_queue.put({"error": f"{operation} raised {e!r}"})
+
+
+def time_operation(root_url, operation, options, verbose):
+    """Run one export or upload against the stand-in and return its timings."""
+    if not verbose:
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+    sys.path.insert(0, SCRIPTS_DIR)
+    from firecloud import api as fapi
+    from common import configure_client
+    from metrics import metrics
+    from export_large_tsv.export_large_tsv import download_tsv_from_workspace
+    from import_large_tsv.import_large_tsv import upload_tsv_to_workspace
+
+    fapi.fcconfig.root_url = root_url
+    # a plain session skips FISS's google authentication, which the stand-in doesn't need
+    setattr(fapi, "__SESSION", requests.Session())
+    configure_client(max(options["concurrency"], options["workers"]), None)
+
+    baseline_rss_mb = get_peak_rss_mb()
+    start = time.perf_counter()
+    if operation == "export":
+        download_tsv_from_workspace(PROJECT, WORKSPACE, options["entity_type"], options["tsv"], options["page_size"],
+                                    None, options["concurrency"])
+    else:
+        upload_tsv_to_workspace(options["tsv"], PROJECT, WORKSPACE, options["chunk_bytes"], options["workers"])
+    seconds = time.perf_counter() - start
+
+    report = metrics.report()
+    return {"seconds": seconds, "baseline_rss_mb": baseline_rss_mb, "peak_rss_mb": get_peak_rss_mb(),
+            "retries": sum(endpoint["retries"] for endpoint in report["endpoints"].values()),
+            "client_metrics": report}
+
+
+def write_synthetic_tsv(tsv, entity_type, rows, attribute_names):
+    """Write a load file with the same rows the stand-in serves for a table of this size."""
+    with open(tsv, "w") as tsvout:
+        tsvout.write("\t".join([f"entity:{entity_type}_id"] + attribute_names) + "\n")
+        for index in range(rows):
+            values = [f"{entity_type}_{index:09d}"] + [f"{name}_value_{index}" for name in attribute_names]
+            tsvout.write("\t".join(values) + "\n")
+
+
+def count_tsv_rows(tsv):
+    """Return the number of rows in a tsv, not counting its header."""
+    with open(tsv, "rb") as tsvfile:
+        return sum(1 for _ in tsvfile) - 1
+
+
+def get_result(run, result_queue):
+    """Wait for the result of a benchmark process, or return an error result if the process dies without one."""
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if not run.is_alive():
+                return {"error": f"benchmark process exited with code {run.exitcode} without a result"}
+
+
+def run_benchmarks(row_counts, operations, columns, options, server_options, workdir, verbose=False):
+    """Run every operation on a synthetic table of each size and return a list of results.
+
+    An operation that fails, or that exports or uploads a different number of rows than the table has, is reported
+    with an error instead of a rate.
+    """
+    context = multiprocessing.get_context("spawn")
+    attribute_names = [f"attribute_{column}" for column in range(columns)]
+    tables = {f"bench_{rows}": (rows, attribute_names) for rows in row_counts}
+
+    port_queue = context.Queue()
+    server = context.Process(target=serve, args=(tables, server_options, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+
+    results = []
+    try:
+        for rows in row_counts:
+            entity_type = f"bench_{rows}"
+            for operation in operations:
+                tsv = os.path.join(workdir, f"{entity_type}.{operation}.tsv")
+                if operation == "upload":
+                    write_synthetic_tsv(tsv, entity_type, rows, attribute_names)
+                requests.post(f"{base_url}/_reset")
+
+                # every run gets a fresh process so its peak RSS isn't inflated by earlier runs
+                result_queue = context.Queue()
+                run = context.Process(target=run_operation, args=(f"{base_url}/api/", operation,
+                                                                  dict(options, entity_type=entity_type, tsv=tsv),
+                                                                  result_queue, verbose))
+                run.start()
+                result = get_result(run, result_queue)
+                run.join()
+
+                server_stats = requests.get(f"{base_url}/_stats").json()
+                if "error" not in result:
+                    # a broken export or upload must not be reported as a fast one
+                    if operation == "export":
+                        result["processed_rows"] = count_tsv_rows(tsv)
+                    else:
+                        result["processed_rows"] = server_stats["uploaded_rows"].get(entity_type, 0)
+                    if result["processed_rows"] != rows:
+                        result["error"] = f"{operation} processed {result['processed_rows']} of {rows} rows"
+                if os.path.exists(tsv):
+                    os.remove(tsv)
+
+                result.update(operation=operation, rows=rows, requests=server_stats["requests"],
+                              uploaded_rows=server_stats["uploaded_rows"])
+                results.append(result)
+                if "error" in result:
+                    print(f"{operation:>6} {rows:>10} rows  FAILED: {result['error']}")
+                    continue
+                result["rows_per_second"] = round(rows / result["seconds"], 1)
+                print(f"{operation:>6} {rows:>10} rows  {result['seconds']:8.2f}s  {result['rows_per_second']:>10.0f} rows/s  "
+                      f"peak RSS {result['peak_rss_mb']:>7.1f} MB (baseline {result['baseline_rss_mb']:.1f} MB)  "
+                      f"{sum(server_stats['requests'].values()):>6} requests  {result['retries']:>4} retries")
+    finally:
+        server.terminate()
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the export and import scripts against a local FireCloud stand-in.")
+    parser.add_argument('-r', '--rows', type=int, nargs='+', default=[10000, 100000], help='Row counts of the synthetic tables, e.g. -r 10000 1000000 10000000')
+    parser.add_argument('-o', '--operations', nargs='+', choices=['export', 'upload'], default=['export', 'upload'], help='Operations to benchmark.')
+    parser.add_argument('-c', '--columns', type=int, default=10, help='Number of attribute columns in the synthetic tables.')
+    parser.add_argument('-n', '--page_size', type=int, default=1000, help='Export page size.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Export pages requested in parallel.')
+    parser.add_argument('--workers', type=int, default=4, help='Upload chunks sent in parallel.')
+    parser.add_argument('--chunk_bytes', type=int, default=4 * 1024 * 1024, help='Starting upload chunk size in bytes.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stand-in delays every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra random seconds the stand-in delays every response.')
+    parser.add_argument('--throttle_rps', type=float, help='Requests per second above which the stand-in answers 429.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests the stand-in fails with 503.')
+    parser.add_argument('--max_payload_bytes', type=int, help='Upload size above which the stand-in answers 413.')
+    parser.add_argument('--workdir', type=str, help='Directory for the synthetic tsv files (default: a temporary directory).')
+    parser.add_argument('--output', type=str, help='Path to write the results to as json.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the scripts being benchmarked.')
+
+    args = parser.parse_args()
+    options = {"page_size": args.page_size, "concurrency": args.concurrency, "workers": args.workers, "chunk_bytes": args.chunk_bytes}
+    server_options = {"latency": args.latency, "jitter": args.jitter, "throttle_rps": args.throttle_rps,
+                      "error_rate": args.error_rate, "max_payload_bytes": args.max_payload_bytes}
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = run_benchmarks(args.rows, args.operations, args.columns, options, server_options, workdir, args.verbose)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Wrote results to {args.output}")
+    if any("error" in result for result in results):
+        exit(1)
@@ -1,33 +1,249 @@
 # -*- coding: utf-8 -*-
 """Common GCS and FISS tools."""
 
+import base64
+import hashlib
+import math
+import os
 import sys
 import logging
+import random
+import requests
+import threading
+import time
+import uuid
 import tenacity as tn
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+from firecloud import api as fapi
 from firecloud import errors as ferrors
-from google.cloud import storage
+from metrics import metrics
 
-logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_SECOND = 20
+# response codes after which a request is retried, and those that mean the server wants us to slow down
+RETRY_CODES = (408, 429, 500, 502, 503, 504)
+THROTTLE_CODES = (429, 503)
+# response codes meaning the request took too long, e.g. a gateway timeout
+TIMEOUT_CODES = (408, 504)
+# bucket uploads stream in chunks of this size (a multiple of 256 KB); larger files are uploaded in parallel parts
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+PARALLEL_UPLOAD_THRESHOLD = 256 * 1024 * 1024
+MAX_COMPOSE_PARTS = 32
+DEFAULT_UPLOAD_WORKERS = 8
+# concurrency is reduced at most once per cooldown, so a burst of throttled responses only halves it once
+THROTTLE_COOLDOWN = 2.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket that limits the rate of requests to `rate` per second, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, float(rate or 1))
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent. A rate of None never blocks."""
+        if not self.rate:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter:
+    """Context manager limiting the number of requests in flight, which backs off when the server throttles.
+
+    The limit is halved when a request is throttled and grows back by one request per limit's worth of successful
+    requests, up to max_concurrency.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self._in_flight = 0
+        self._last_throttled = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        """Halve the concurrency limit after a throttled response."""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_throttled < THROTTLE_COOLDOWN or self.limit <= 1:
+                return
+            self._last_throttled = now
+            self.limit = max(1.0, self.limit / 2)
+            logger.warning('Request throttled by server, reducing concurrency to %s', int(self.limit))
+
+    def succeeded(self):
+        """Grow the concurrency limit back towards max_concurrency after a successful response."""
+        with self._condition:
+            if self.limit < self.max_concurrency:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+
+class BoundedSubmitter:
+    """Submits tasks to an executor with at most max_in_flight of them unfinished or not yet collected at a time.
+
+    submit() waits for a task to finish while max_in_flight are in flight, so a loop reading work from a file or a
+    stream only holds a bounded amount of it in memory. The context given with each task and its result are passed
+    to on_done(context, result) in the submitting thread, so on_done can update counts, progress bars or journals
+    without a lock.
+    """
+
+    def __init__(self, executor, max_in_flight, on_done):
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.on_done = on_done
+        self._in_flight = {}
+
+    def _collect(self, futures):
+        for future in futures:
+            context = self._in_flight.pop(future)
+            self.on_done(context, future.result())
+
+    def submit(self, context, fn, *args, **kwargs):
+        """Wait until fewer than max_in_flight tasks are in flight, then submit fn(*args, **kwargs)."""
+        while len(self._in_flight) >= self.max_in_flight:
+            self._collect(wait(self._in_flight, return_when=FIRST_COMPLETED).done)
+        self._in_flight[self.executor.submit(fn, *args, **kwargs)] = context
+
+    def wait_all(self):
+        """Wait for every task in flight and collect its result."""
+        self._collect(wait(self._in_flight).done)
+
+
+# shared by every call_fiss call in the process, see configure_client()
+_rate_limiter = TokenBucket(DEFAULT_REQUESTS_PER_SECOND)
+_concurrency_limiter = AdaptiveConcurrencyLimiter(DEFAULT_MAX_CONCURRENCY)
+_pool_size = DEFAULT_MAX_CONCURRENCY
+_session_configured = False
+_session_lock = threading.Lock()
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def configure_client(max_concurrency=DEFAULT_MAX_CONCURRENCY, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """Set the limits shared by all call_fiss calls: requests in flight (also the connection pool size) and requests per second.
+
+    Call this before the first call_fiss call; requests_per_second=None removes the rate limit. Also sends log
+    messages, such as retries, to stderr unless the application has already configured logging.
+    """
+    global _rate_limiter, _concurrency_limiter, _pool_size
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    _rate_limiter = TokenBucket(requests_per_second)
+    _concurrency_limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+    _pool_size = max_concurrency
+
+
+def _configure_session():
+    """Size the keep-alive connection pool of the session FISS sends every request through."""
+    global _session_configured
+    with _session_lock:
+        if _session_configured:
+            return
+        # creates and authorizes the FISS session if it doesn't exist yet
+        fapi._set_session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=_pool_size, pool_maxsize=_pool_size)
+        session = getattr(fapi, "__SESSION")
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session_configured = True
+
+
+def get_retry_after(response):
+    """Return the number of seconds a response's Retry-After header asks to wait, or None."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exception):
+    """Return True for errors worth retrying: connection problems, timeouts, throttling and server errors."""
+    if isinstance(exception, ferrors.FireCloudServerError):
+        return exception.code in RETRY_CODES
+    return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+
+
+def is_retryable_at_same_size(exception):
+    """Return True for errors worth retrying with the same payload: like is_retryable, but not timeouts, since a
+    request that timed out reading the response would most likely time out again."""
+    if isinstance(exception, requests.ReadTimeout):
+        return False
+    if isinstance(exception, ferrors.FireCloudServerError) and exception.code in TIMEOUT_CODES:
+        return False
+    return is_retryable(exception)
+
+
+_backoff = tn.wait_random_exponential(multiplier=2, max=60)
+
+
+def wait_retry_after_or_backoff(retry_state):
+    """Wait as long as the server asked with Retry-After, otherwise use jittered exponential backoff."""
+    retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+    return _backoff(retry_state)
+
+
+def get_endpoint_name(fapifunc):
+    """Return the name metrics are recorded under for a fiss api function."""
+    return getattr(fapifunc, "__name__", str(fapifunc))
+
 
 def my_before_sleep(retry_state):
     if retry_state.attempt_number < 1:
         loglevel = logging.INFO
     else:
         loglevel = logging.WARNING
+    # log the api function rather than all of its args, which can include a whole upload payload
+    endpoint = get_endpoint_name(retry_state.args[0]) if retry_state.args else retry_state.fn
     logger.log(
-        loglevel, 'Retrying %s with %s in %s seconds; attempt #%s ended with: %s',
-        retry_state.fn, retry_state.args, str(int(retry_state.next_action.sleep)), retry_state.attempt_number, retry_state.outcome)
+        loglevel, 'Retrying %s in %s seconds; attempt #%s ended with: %s',
+        endpoint, str(int(retry_state.next_action.sleep)), retry_state.attempt_number, retry_state.outcome)
+    metrics.record_retry(endpoint)
 
 
-@tn.retry(wait=tn.wait_chain(*[tn.wait_fixed(5)]
-                             + [tn.wait_fixed(10)]
-                             + [tn.wait_fixed(30)]
-                             + [tn.wait_fixed(60)]),
+@tn.retry(wait=wait_retry_after_or_backoff,
+          retry=tn.retry_if_exception(is_retryable),
           stop=tn.stop_after_attempt(5),
-          before_sleep=my_before_sleep)
+          before_sleep=my_before_sleep,
+          reraise=True)
 def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
     ''' call FISS (firecloud api), check for errors, return json response
 
@@ -45,9 +261,30 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
 
     example use:
         output = call_fiss(fapi.get_workspace, 200, 'help-gatk', 'Sequence-Format-Conversion')
+
+    requests are sent through a shared, pooled session and are limited in rate and concurrency (see configure_client);
+    connection errors, throttling and server errors are retried with jittered exponential backoff, or after the
+    Retry-After the server asked for.
     '''
+    _configure_session()
+
     # call the api
-    response = fapifunc(*args, **kwargs)
+    _rate_limiter.acquire()
+    with _concurrency_limiter:
+        start = time.perf_counter()
+        try:
+            response = fapifunc(*args, **kwargs)
+        except Exception:
+            metrics.record_call(get_endpoint_name(fapifunc), time.perf_counter() - start, error=True)
+            raise
+    request_body = response.request.body if response.request is not None else None
+    metrics.record_call(get_endpoint_name(fapifunc), time.perf_counter() - start, response.status_code,
+                        len(request_body) if request_body else 0, len(response.content), response.status_code >= 400)
+
+    if response.status_code in THROTTLE_CODES:
+        _concurrency_limiter.throttled()
+    else:
+        _concurrency_limiter.succeeded()
 
     # check for errors; this is copied from _check_response_code in fiss
     if type(okcode) == int:
@@ -58,7 +295,9 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
             codes = [okcode] + specialcodes
     if response.status_code not in codes:
         print(response.content)
-        raise ferrors.FireCloudServerError(response.status_code, response.content)
+        error = ferrors.FireCloudServerError(response.status_code, response.content)
+        error.retry_after = get_retry_after(response)
+        raise error
     elif specialcodes is not None:
         return response
 
@@ -66,17 +305,87 @@ def call_fiss(fapifunc, okcode, *args, specialcodes=None, **kwargs):
     return response.json()
 
 
-def write_file_to_bucket(local_file_path, file_name, bucket_name):
-    """Write a string to a file in a bucket."""
-    # set up cloud storage client
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+def hash64(text):
+    """Return a 64-bit hash of a string, e.g. to keep millions of entity names or paths in memory as 8 bytes each."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def get_storage_client():
+    """Return the cloud storage client shared by every upload in this process."""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            # only imported once a bucket is used, so scripts that never touch a bucket start faster
+            from google.cloud import storage
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def get_file_crc32c(local_file_path):
+    """Return the base64 encoded CRC32C of a local file, in the form GCS reports it for objects, reading it in chunks."""
+    import google_crc32c
+    checksum = google_crc32c.Checksum()
+    with open(local_file_path, "rb") as local_file:
+        for chunk in iter(lambda: local_file.read(DEFAULT_UPLOAD_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
 
-    blob = bucket.blob(file_name)
+def upload_file_part(bucket, part_name, local_file_path, offset, size):
+    """Upload size bytes of a local file starting at offset to a new object, streaming it in resumable chunks."""
+    part = bucket.blob(part_name, chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE)
+    with open(local_file_path, "rb") as local_file:
+        local_file.seek(offset)
+        part.upload_from_file(local_file, size=size)
+    return part
 
-    blob.upload_from_string(local_file_path)
 
+def write_file_to_bucket(local_file_path, file_name, bucket_name, workers=DEFAULT_UPLOAD_WORKERS,
+                         parallel_threshold=PARALLEL_UPLOAD_THRESHOLD):
+    """Upload a local file to a file in a bucket, skipping the upload if an identical file is already there.
+
+    The file is streamed from disk in resumable chunks. Files larger than parallel_threshold bytes are uploaded as up
+    to MAX_COMPOSE_PARTS parts by `workers` threads and composed into a single object. The uploaded object's CRC32C is
+    checked against the local file.
+    """
+    bucket_name = bucket_name[len("gs://"):] if bucket_name.startswith("gs://") else bucket_name
     uri = f"gs://{bucket_name}/{file_name}"
+    bucket = get_storage_client().bucket(bucket_name)
+
+    # composite objects only have a crc32c, so that is what is compared rather than the md5
+    local_crc32c = get_file_crc32c(local_file_path)
+    existing_blob = bucket.get_blob(file_name)
+    if existing_blob is not None and existing_blob.crc32c == local_crc32c:
+        print(f"{uri} already matches {local_file_path}, skipping upload")
+        return uri
+
+    file_size = os.path.getsize(local_file_path)
+    if file_size <= parallel_threshold:
+        blob = bucket.blob(file_name, chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE)
+        blob.upload_from_filename(local_file_path)
+    else:
+        # parts are whole upload chunks so each one streams in full chunks
+        part_size = max(DEFAULT_UPLOAD_CHUNK_SIZE, math.ceil(file_size / MAX_COMPOSE_PARTS / DEFAULT_UPLOAD_CHUNK_SIZE) * DEFAULT_UPLOAD_CHUNK_SIZE)
+        offsets = range(0, file_size, part_size)
+        part_prefix = f"{file_name}.parts-{uuid.uuid4().hex}/"
+        parts = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(upload_file_part, bucket, f"{part_prefix}{index:02d}", local_file_path,
+                                           offset, min(part_size, file_size - offset))
+                           for index, offset in enumerate(offsets)]
+                for future in futures:
+                    parts.append(future.result())
+            blob = bucket.blob(file_name)
+            blob.compose(parts)
+        finally:
+            for part in bucket.list_blobs(prefix=part_prefix):
+                part.delete()
+
+    blob.reload()
+    if blob.crc32c != local_crc32c:
+        raise ValueError(f"CRC32C of {uri} ({blob.crc32c}) does not match {local_file_path} ({local_crc32c})")
+
     print(f"Saved file to {uri}")
 
     return uri
@@ -1,44 +1,289 @@
 # -*- coding: utf-8 -*-
 """Download a remote tsv from a Terra workspace data model when it is too large to export from Terra UI."""
 from firecloud import api as fapi
+from collections import deque
+from common import DEFAULT_REQUESTS_PER_SECOND, call_fiss, configure_client
+from concurrent.futures import ThreadPoolExecutor
+from metrics import add_metrics_arguments, metrics, reporting
 from tqdm import tqdm
 import argparse
+import gzip
+import json
 import math
+import os
 
 DEFAULT_PAGE_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+DEFAULT_ROW_GROUP_ROWS = 100000
+OUTPUT_FORMATS = ("tsv", "tsv.gz", "ndjson", "parquet")
+# formats written as plain text, which an interrupted export can be truncated and resumed in
+RESUMABLE_FORMATS = ("tsv", "ndjson")
 
 
-def get_entity_by_page(project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None):
-    """Get entities from workspace by page given a page_size(number of entities/rows in entity table)."""
-    # API = https://api.firecloud.org/#!/Entities/entityQuery
-    response = fapi.get_entities_query(project, workspace, entity_type, page=page,
-                                       page_size=page_size, sort_direction=sort_direction,
-                                       filter_terms=filter_terms)
-
-    if response.status_code != 200:
-        print(response.text)
-        exit(1)
+def get_entity_by_page(project, workspace, entity_type, page, page_size=DEFAULT_PAGE_SIZE, sort_direction='asc', filter_terms=None, fields=None):
+    """Get entities from workspace by page given a page_size(number of entities/rows in entity table).
 
-    return(response.json())
+    fields is an optional comma-separated list of attribute names; only those attributes are sent by the server.
+    """
+    # API = https://api.firecloud.org/#!/Entities/entityQuery
+    return call_fiss(fapi.get_entities_query, 200, project, workspace, entity_type, page=page,
+                     page_size=page_size, sort_direction=sort_direction,
+                     filter_terms=filter_terms, fields=fields)
 
 
-def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None):
-    """Download large TSV file from Terra workspace by designated number of rows."""
+def get_entity_types(project, workspace):
+    """Get the entity types in the workspace with their entity count, id column name and attribute names."""
     # get all entity types in workspace using API call
     # API = https://api.firecloud.org/#!/Entities/getEntityTypes
-    response = fapi.list_entity_types(project, workspace)
-    if response.status_code != 200:
-        print(response.text)
-        exit(1)
+    return call_fiss(fapi.list_entity_types, 200, project, workspace)
+
+
+def iter_entity_pages(project, workspace, entity_type, pages, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, fields=None):
+    """Fetch the given pages concurrently and yield (page, response) tuples in page order.
+
+    At most `concurrency` pages are requested or held in memory at any time; the next page is only
+    requested once the oldest outstanding page has been handed back to the caller.
+    """
+    pages = iter(pages)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for page in pages:
+            in_flight.append((page, executor.submit(get_entity_by_page, project, workspace, entity_type, page, page_size, fields=fields)))
+            if len(in_flight) >= concurrency:
+                break
+
+        while in_flight:
+            page, future = in_flight.popleft()
+            page_response = future.result()
+            # keep the window full before handing the page back so the workers never sit idle
+            next_page = next(pages, None)
+            if next_page is not None:
+                in_flight.append((next_page, executor.submit(get_entity_by_page, project, workspace, entity_type, next_page, page_size, fields=fields)))
+            yield page, page_response
+
+
+def format_tsv_value(value):
+    """Return an attribute value from the API the way it is written in a load file.
+
+    Lists and json attributes are written as json. References are written as {"entityType", "entityName"} json and
+    lists of references as json lists of them, the only form uploads with the flexible model import as a reference
+    rather than a string.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, dict):
+        return json.dumps(value["items"] if "items" in value and "itemsType" in value else value)
+    if isinstance(value, list):
+        return json.dumps(value)
+    return str(value)
+
+
+def get_typed_value(value):
+    """Return an attribute value from the API as a plain value: lists as lists, references as entity names."""
+    if isinstance(value, dict):
+        if "entityName" in value:
+            return value["entityName"]
+        if "items" in value:
+            return [get_typed_value(item) for item in value["items"]]
+        return json.dumps(value)
+    return value
+
+
+def write_page_to_tsv(tsvout, page_response, entity_id, attribute_names):
+    """Write the entities of a single page response to an open tsv file and return the number of rows written."""
+    row_num = 0
+    # for each set of attributes in results (no parameters) get attribute names and entity_id(name)
+    for entity_json in page_response["results"]:
+        attributes = entity_json["attributes"]
+        name = entity_json["name"]
+        # add name and value to dictionary of attributes
+        attributes[entity_id] = name
+
+        # for each attribute(column name) in list of attribute names(all columns for entity), empty if the entity doesn't have it
+        values = [format_tsv_value(attributes.get(attribute_name)) for attribute_name in attribute_names]
+
+        tsvout.write("\t".join(values) + "\n")
+        row_num += 1
+
+    return row_num
+
+
+def write_page_to_ndjson(jsonout, page_response, entity_id, attribute_names):
+    """Write the entities of a single page response to an open file as a json object per line and return the number of rows written."""
+    row_num = 0
+    for entity_json in page_response["results"]:
+        attributes = entity_json["attributes"]
+        attributes[entity_id] = entity_json["name"]
+        row = {attribute_name: get_typed_value(attributes[attribute_name])
+               for attribute_name in attribute_names if attribute_name in attributes}
+        jsonout.write(json.dumps(row) + "\n")
+        row_num += 1
+
+    return row_num
+
+
+class ParquetPageWriter:
+    """Writes pages of entities to a Parquet file as typed columns, in row groups of row_group_rows rows.
+
+    Column types are inferred from the first row group, and columns without any values in it are written as
+    strings. If a later row group doesn't fit a column's type, the column is widened: an integer column becomes a
+    double column when a float turns up, and any other mismatch makes it a string column. The row groups already
+    written are then rewritten with the widened types, one row group at a time.
+    """
+
+    def __init__(self, path, attribute_names, row_group_rows=DEFAULT_ROW_GROUP_ROWS):
+        # pyarrow is only needed for parquet exports, so it is only imported when one is written
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.attribute_names = attribute_names
+        self.row_group_rows = row_group_rows
+        self.columns = {attribute_name: [] for attribute_name in attribute_names}
+        self.num_rows = 0
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
+    def write_page(self, page_response, entity_id):
+        """Buffer the entities of a single page response, writing a row group once enough are buffered, and return the number of rows."""
+        for entity_json in page_response["results"]:
+            attributes = entity_json["attributes"]
+            attributes[entity_id] = entity_json["name"]
+            for attribute_name, values in self.columns.items():
+                values.append(get_typed_value(attributes.get(attribute_name)))
+        self.num_rows += len(page_response["results"])
+
+        if self.num_rows >= self.row_group_rows:
+            self.flush()
+        return len(page_response["results"])
+
+    def to_string_array(self, values):
+        """Return values as a string array, with lists as json and booleans as true/false like in a tsv."""
+        return self.pa.array([None if value is None else json.dumps(value) if isinstance(value, list)
+                              else ("true" if value else "false") if isinstance(value, bool) else str(value)
+                              for value in values], type=self.pa.string())
+
+    def infer_type(self, values):
+        """Return the arrow type of a column of values, null if it has no values and string if the values are mixed."""
+        try:
+            return self.pa.array(values).type
+        except (self.pa.ArrowInvalid, self.pa.ArrowTypeError):
+            return self.pa.string()
+
+    def widen_type(self, current_type, new_type):
+        """Return the narrowest type that holds values of both types."""
+        types = self.pa.types
+        if new_type == current_type or types.is_null(new_type):
+            return current_type
+        if types.is_list(current_type) and types.is_list(new_type):
+            if types.is_null(new_type.value_type):
+                return current_type
+            value_type = self.widen_type(current_type.value_type, new_type.value_type)
+            return self.pa.list_(value_type) if value_type != self.pa.string() else self.pa.string()
+        if {current_type, new_type} == {self.pa.int64(), self.pa.float64()}:
+            return self.pa.float64()
+        return self.pa.string()
+
+    def to_array(self, values, arrow_type):
+        """Return values as an array of arrow_type, which must be a type widen_type returned for them."""
+        if arrow_type == self.pa.string():
+            return self.to_string_array(values)
+        return self.pa.array(values, type=arrow_type)
+
+    def rewrite(self, schema):
+        """Rewrite the row groups written so far with the columns of the widened schema."""
+        self.writer.close()
+        written_path = self.path + ".widening"
+        os.replace(self.path, written_path)
+        written = self.pq.ParquetFile(written_path)
+        self.writer = self.pq.ParquetWriter(self.path, schema)
+        for row_group in range(written.num_row_groups):
+            table = written.read_row_group(row_group)
+            arrays = [column if column.type == field.type else self.to_array(column.to_pylist(), field.type)
+                      for column, field in zip(table.columns, schema)]
+            self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=schema))
+        os.remove(written_path)
+
+    def flush(self):
+        """Write the buffered rows as a row group, widening the file's column types if they don't fit."""
+        if self.writer is None:
+            types = [self.infer_type(values) for values in self.columns.values()]
+            # columns without a value to infer a type from are written as strings
+            types = [self.pa.string() if self.pa.types.is_null(arrow_type) else
+                     self.pa.list_(self.pa.string()) if self.pa.types.is_list(arrow_type) and self.pa.types.is_null(arrow_type.value_type)
+                     else arrow_type for arrow_type in types]
+            schema = self.pa.schema(list(zip(self.columns, types)))
+            self.writer = self.pq.ParquetWriter(self.path, schema)
+        else:
+            schema = self.pa.schema([(field.name, self.widen_type(field.type, self.infer_type(values)))
+                                     for field, values in zip(self.writer.schema, self.columns.values())])
+            if schema != self.writer.schema:
+                widened = [f"{field.name} to {field.type}" for field, old_field in zip(schema, self.writer.schema) if field.type != old_field.type]
+                print(f"Widening column(s) {', '.join(widened)} and rewriting the row groups already written.")
+                self.rewrite(schema)
+
+        arrays = [self.to_array(values, field.type) for values, field in zip(self.columns.values(), schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=schema))
+        self.columns = {attribute_name: [] for attribute_name in self.attribute_names}
+        self.num_rows = 0
+
+    def close(self):
+        if self.num_rows or self.writer is None:
+            self.flush()
+        self.writer.close()
+
+
+def get_checkpoint_path(tsv_name):
+    """Return the path of the sidecar checkpoint file kept next to an exported tsv."""
+    return tsv_name + ".checkpoint"
+
+
+def read_checkpoint(checkpoint_path):
+    """Read an export checkpoint, returning None if there isn't one."""
+    if not os.path.isfile(checkpoint_path):
+        return None
+
+    with open(checkpoint_path, "r") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    """Atomically replace the export checkpoint so an interrupted run never leaves a partial file behind."""
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_size=DEFAULT_PAGE_SIZE, attr_list=None, concurrency=DEFAULT_CONCURRENCY, resume=False, output_format="tsv"):
+    """Download large TSV file from Terra workspace by designated number of rows.
+
+    output_format is one of "tsv", "tsv.gz", "ndjson" (a json object per entity per line) or "parquet". If attr_list
+    is given, only those attributes are requested from the server.
+
+    If resume is True (tsv and ndjson only), a checkpoint recording the last page written and the byte offset of the end of that
+    page in the tsv is kept next to the tsv. Re-running the same export continues after the last committed page.
+    """
     # get/report # of entities + associated attributes(column names) of input entity type
-    entity_types_json = response.json()
+    entity_types_json = get_entity_types(project, workspace)
     entity_count = entity_types_json[entity_type]["count"]
     entity_id = entity_types_json[entity_type]["idName"]
     # if user provided list of specific attributes to return, else return all attributes
+    fields = None
     if attr_list:
         all_attribute_names = entity_types_json[entity_type]["attributeNames"]
         attribute_names = [attr for attr in all_attribute_names if attr in attr_list]
+        # only ask the server for the requested attributes, so the others are never transferred; if none of them
+        # exist, ask for the id column, which isn't an attribute, so only the entity names are sent
+        fields = ",".join(attribute_names) if attribute_names else entity_id
     else:
         attribute_names = entity_types_json[entity_type]["attributeNames"]
 
@@ -47,43 +292,71 @@ def download_tsv_from_workspace(project, workspace, entity_type, tsv_name, page_
 
     print(f'{entity_count} {entity_type}(s) to export.')
 
-    with open(tsv_name, "w") as tsvout:
-        # add header with attribute values to tsv
-        tsvout.write("\t".join(attribute_names) + "\n")
-        # set starting row value and calculate number of pages
-        row_num = 0
-        num_pages = int(math.ceil(float(entity_count) / page_size))
-
-        # get entities by page where each page has page_size # of rows using API call
-        print(f'Getting all {num_pages} pages of entity data.')
-        all_page_responses = []
-        for page in tqdm(range(1, num_pages + 1)):
-            all_page_responses.append(get_entity_by_page(project, workspace, entity_type, page, page_size))
+    if resume and output_format not in RESUMABLE_FORMATS:
+        print(f'Resuming is only supported for {" and ".join(RESUMABLE_FORMATS)} exports, not {output_format}.')
+        exit(1)
 
-        # for each response(page) in all_page_responses[] - contains parameter metadata
-        print(f'Writing {entity_count} attributes to tsv file.')
-        for page_response in tqdm(all_page_responses):
-            # for each set of attributes in results (no parameters) get attribute names and entity_id(name)
-            for entity_json in page_response["results"]:
-                attributes = entity_json["attributes"]
-                name = entity_json["name"]
-                # add name and value to dictionary of attributes
-                attributes[entity_id] = name
+    # the parameters that must be unchanged for a checkpoint to be reused
+    export_params = {"project": project, "workspace": workspace, "entity_type": entity_type,
+                     "page_size": page_size, "attribute_names": attribute_names,
+                     "output_format": output_format}
+    checkpoint_path = get_checkpoint_path(tsv_name)
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is not None and ({key: checkpoint.get(key) for key in export_params} != export_params
+                                   or not os.path.isfile(tsv_name)):
+        print(f'Ignoring checkpoint {checkpoint_path}, it was written by an export with different parameters.')
+        checkpoint = None
 
-                values = []
-                # for each attribute(column name) in list of attribute names(all columns for entity)
-                for attribute_name in attribute_names:
-                    value = ""
-                    # if entity's attribute(column) is in list of attributes from response, set response's attribute value
-                    if attribute_name in attributes:
-                        value = attributes[attribute_name]
+    num_pages = int(math.ceil(float(entity_count) / page_size))
+    if checkpoint is None:
+        if output_format == "parquet":
+            tsvout = ParquetPageWriter(tsv_name, attribute_names)
+        else:
+            tsvout = gzip.open(tsv_name, "wt") if output_format == "tsv.gz" else open(tsv_name, "w")
+            if output_format != "ndjson":
+                # start a new tsv and add header with attribute values
+                tsvout.write("\t".join(attribute_names) + "\n")
+        start_page = 1
+        row_num = 0
+    else:
+        # drop anything written after the last committed page and continue from the following page
+        tsvout = open(tsv_name, "r+")
+        tsvout.seek(checkpoint["offset"])
+        tsvout.truncate()
+        start_page = checkpoint["last_page"] + 1
+        row_num = checkpoint["rows"]
+        print(f'Resuming export from page {start_page} of {num_pages} ({row_num} {entity_type}(s) already written).')
+        if checkpoint["entity_count"] != entity_count:
+            print(f'WARNING: the number of {entity_type}(s) changed from {checkpoint["entity_count"]} to {entity_count} since the '
+                  f'checkpoint was written. Page boundaries may have shifted, so rows may be duplicated or missing; '
+                  f'delete {checkpoint_path} to export from the beginning.')
 
-                    values.append(str(value))
+    with tsvout:
+        # get entities by page where each page has page_size # of rows using API call
+        # pages are fetched concurrently but written in page order as soon as each one is ready,
+        # so only `concurrency` pages are ever held in memory
+        print(f'Getting and writing {num_pages - start_page + 1} pages of entity data ({concurrency} concurrent requests).')
+        page_responses = iter_entity_pages(project, workspace, entity_type, range(start_page, num_pages + 1), page_size, concurrency, fields)
+        for page, page_response in tqdm(page_responses, total=num_pages - start_page + 1):
+            with metrics.timed(f"write_page_to_{output_format}"):
+                if output_format == "parquet":
+                    page_rows = tsvout.write_page(page_response, entity_id)
+                elif output_format == "ndjson":
+                    page_rows = write_page_to_ndjson(tsvout, page_response, entity_id, attribute_names)
+                else:
+                    page_rows = write_page_to_tsv(tsvout, page_response, entity_id, attribute_names)
+            metrics.record_rows("exported", page_rows)
+            row_num += page_rows
+            if resume:
+                # commit the page: the tsv must be on disk up to the recorded offset before the checkpoint moves past it
+                tsvout.flush()
+                write_checkpoint(checkpoint_path, dict(export_params, entity_count=entity_count, last_page=page,
+                                                       offset=tsvout.tell(), rows=row_num))
 
-                tsvout.write("\t".join(values) + "\n")
-                row_num += 1
+    if resume and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
 
-    print(f'Finished exporting {entity_type}(s) to tsv with name {tsv_name}.')
+    print(f'Finished exporting {row_num} {entity_type}(s) to {output_format} with name {tsv_name}.')
 
 
 if __name__ == "__main__":
@@ -94,8 +367,16 @@ if __name__ == "__main__":
     parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
     parser.add_argument('-e', '--entity_type', type=str, required=True, help='Entity type being requested for tsv export to local destination.')
     parser.add_argument('-f', '--tsv_filename', type=str, required=True, help='Name of tsv file to be exported from Terra to local destination.')
+    parser.add_argument('--format', type=str, choices=OUTPUT_FORMATS, default='tsv', help='Format of the exported file.')
     parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to export per page.')
     parser.add_argument('-a', '--attribute_list', nargs='+', help='column names to return - separated by spaces. ex. -a col1 col2')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of pages to request in parallel.')
+    parser.add_argument('-r', '--resume', action='store_true', help='Keep a checkpoint next to the tsv and continue an interrupted export from the last page written.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    download_tsv_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list)
+    configure_client(args.concurrency, args.requests_per_second)
+    with reporting(args):
+        download_tsv_from_workspace(args.project, args.workspace, args.entity_type, args.tsv_filename, args.page_size, args.attribute_list, args.concurrency, args.resume, args.format)
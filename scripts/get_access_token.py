@@ -1,14 +1,20 @@
 ##!/usr/bin/env python
 
 import argparse
+import hashlib
+import json
 import os
-from oauth2client.client import GoogleCredentials
-from oauth2client.service_account import ServiceAccountCredentials
+import time
 
+DEFAULT_SCOPES = ['https://www.googleapis.com/auth/userinfo.profile', 'https://www.googleapis.com/auth/userinfo.email']
+DEFAULT_TOKEN_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "terra-tools", "access_tokens.json")
+# cached tokens are only returned if they stay valid for at least this many seconds
+TOKEN_EXPIRY_MARGIN = 300
 
-def get_access_token(json_credentials, new_scopes=None):
-    """Takes a path to a service account's json credentials file and return an access token with scopes."""
-    scopes = ['https://www.googleapis.com/auth/userinfo.profile', 'https://www.googleapis.com/auth/userinfo.email']
+
+def get_scopes(new_scopes=None):
+    """Return the scopes to request: the default profile and email scopes plus any new_scopes."""
+    scopes = list(DEFAULT_SCOPES)
 
     if new_scopes is not None:
         if isinstance(new_scopes, list):
@@ -19,10 +25,97 @@ def get_access_token(json_credentials, new_scopes=None):
                   "\n\tpython get_access_token.py <credentials/default> \"['https://www.googleapis.com/auth/cloud-platform']\"")
             exit(1)
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        json_credentials, scopes=scopes)
+    return scopes
+
+
+def get_access_token_info(json_credentials=None, new_scopes=None):
+    """Return (access token, seconds until it expires) for a service account's json credentials file, or for the
+    application default credentials if json_credentials is None."""
+    # oauth2client is slow to import, so it is only imported when a token has to be fetched
+    from oauth2client.client import GoogleCredentials
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    if json_credentials is None:
+        token_info = GoogleCredentials.get_application_default().get_access_token()
+    else:
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            json_credentials, scopes=get_scopes(new_scopes))
+        token_info = credentials.get_access_token()
+
+    return token_info.access_token, token_info.expires_in
+
+
+def get_access_token(json_credentials, new_scopes=None):
+    """Takes a path to a service account's json credentials file and return an access token with scopes."""
+    return get_access_token_info(json_credentials, new_scopes)[0]
+
+
+def read_token_cache(cache_path):
+    """Read the token cache, returning an empty cache if there isn't a readable one."""
+    try:
+        with open(cache_path, "r") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
 
-    return credentials.get_access_token().access_token
+
+def write_token_cache(cache_path, cache):
+    """Atomically replace the token cache, readable only by the current user."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, cache_path)
+
+
+def get_application_default_path():
+    """Return the path of the application default credentials file, as gcloud and the google auth libraries find it."""
+    if os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"):
+        return os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
+    if os.name == "nt":
+        config_dir = os.path.join(os.environ.get("APPDATA", ""), "gcloud")
+    else:
+        config_dir = os.environ.get("CLOUDSDK_CONFIG") or os.path.join(os.path.expanduser("~"), ".config", "gcloud")
+    return os.path.join(config_dir, "application_default_credentials.json")
+
+
+def get_cache_key(json_credentials=None, new_scopes=None):
+    """Return the key a token is cached under: the credentials file, a hash of its content, and the scopes.
+
+    The hash changes when the file is replaced, e.g. by `gcloud auth application-default login` with another
+    account, so a token of the previous identity is never returned.
+    """
+    credentials_path = os.path.abspath(json_credentials or get_application_default_path())
+    try:
+        with open(credentials_path, "rb") as credentials_file:
+            credentials_hash = hashlib.sha256(credentials_file.read()).hexdigest()
+    except OSError:
+        # no file, e.g. application default credentials from the metadata server of a Google Compute Engine VM
+        credentials_hash = None
+    scopes = None if json_credentials is None else get_scopes(new_scopes)
+    return json.dumps([credentials_path, credentials_hash, scopes])
+
+
+def get_cached_access_token(json_credentials=None, new_scopes=None, cache_path=DEFAULT_TOKEN_CACHE):
+    """Return an access token like get_access_token_info, reusing a token cached on disk until shortly before it expires.
+
+    Tokens are cached per credentials (see get_cache_key) and scopes, so repeated calls only fetch a new token
+    about once an hour.
+    """
+    cache_key = get_cache_key(json_credentials, new_scopes)
+
+    cache = read_token_cache(cache_path)
+    cached = cache.get(cache_key)
+    if cached is not None and cached["expires_at"] - TOKEN_EXPIRY_MARGIN > time.time():
+        return cached["access_token"]
+
+    access_token, expires_in = get_access_token_info(json_credentials, new_scopes)
+    if expires_in:
+        # drop expired tokens of other credentials while the cache is rewritten
+        cache = {key: token for key, token in cache.items() if token["expires_at"] > time.time()}
+        cache[cache_key] = {"access_token": access_token, "expires_at": time.time() + expires_in}
+        write_token_cache(cache_path, cache)
+    return access_token
 
 
 if __name__ == "__main__":
@@ -31,12 +124,17 @@ if __name__ == "__main__":
     parser.add_argument('-j', '--json_credentials', help='Path to the json credentials file for this service account.')
     parser.add_argument('-d', '--default', action='store_true', help='Print application default credentials access token.')
     parser.add_argument('--new_scopes', type=list, help='Additional scopes to add, in the form of a list')
+    parser.add_argument('--no_cache', action='store_true', help='Always fetch a new token instead of reusing one cached on disk.')
+    parser.add_argument('--token_cache', type=str, default=DEFAULT_TOKEN_CACHE, help='Path of the file access tokens are cached in until they expire.')
 
     args = parser.parse_args()
 
     if args.default:
-        print(GoogleCredentials.get_application_default().get_access_token().access_token)
-        exit(1)
+        if args.no_cache:
+            print(get_access_token_info()[0])
+        else:
+            print(get_cached_access_token(cache_path=args.token_cache))
+        exit(0)
     if args.json_credentials is None or not os.path.isfile(args.json_credentials):
         print("This script will print out an access token for either the application default credentials or for a service account.  "
               "\nOnly the token is printed so this can be combined with other commands such as curl calls.")
@@ -45,4 +143,7 @@ if __name__ == "__main__":
               "\n\tpython3 get_access_token.py -j <path to service account json file> (to get access token for a service account)")
         exit(1)
 
-    print(get_access_token(args.json_credentials, args.new_scopes))
+    if args.no_cache:
+        print(get_access_token(args.json_credentials, args.new_scopes))
+    else:
+        print(get_cached_access_token(args.json_credentials, args.new_scopes, args.token_cache))
@@ -1,16 +1,178 @@
 # -*- coding: utf-8 -*-
 """Upload multiple local tsv to a Terra workspace data model when they are too large to import using the Terra UI."""
 import argparse
+import json
+import threading
+import time
+from common import DEFAULT_REQUESTS_PER_SECOND, configure_client
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from import_large_tsv import upload_tsv_to_workspace
+from metrics import add_metrics_arguments, reporting
 
-def import_large_tsvs(tsv, project, workspace):
-    """Import all load files listed in the input tsv file."""
+DEFAULT_MAX_TABLES = 4
+DEFAULT_MAX_UPLOADS = 8
+# rows at the start of each load file searched for json references to other entity types
+DEPENDENCY_SAMPLE_ROWS = 1000
+
+
+def read_table_header(data_table):
+    """Return (load file type, entity type, column names) from the header of a data table load file.
+
+    e.g. a header of "membership:sample_set_id  sample" returns ("membership", "sample_set", ["sample"]).
+    """
+    with open(data_table, 'r') as tsvfile:
+        header = tsvfile.readline().rstrip("\r\n").split("\t")
+
+    load_type, _, id_column = header[0].partition(":")
+    entity_type = id_column[:-len("_id")] if id_column.endswith("_id") else id_column
+    return load_type, entity_type, header[1:]
+
+
+def get_referenced_types(value):
+    """Return the entity types referenced by an {"entityType", "entityName"} reference, a list of them, or a
+    reference list from the entity API, and an empty set for any other value."""
+    if isinstance(value, dict) and "entityType" in value and "entityName" in value:
+        return {value["entityType"]}
+    if isinstance(value, dict) and value.get("itemsType") == "EntityReference":
+        value = value["items"]
+    if isinstance(value, list):
+        return {referenced_type for item in value for referenced_type in get_referenced_types(item)}
+    return set()
+
+
+def read_referenced_types(data_table, max_rows=DEPENDENCY_SAMPLE_ROWS):
+    """Return the entity types referenced by json reference cells in the first max_rows rows of a load file.
+
+    With the flexible model a reference column can have any name (e.g. case_sample in a pair table), so the
+    header alone doesn't show which tables a load file references.
+    """
+    referenced_types = set()
+    with open(data_table, 'r') as tsvfile:
+        tsvfile.readline()
+        for row_number, line in enumerate(tsvfile):
+            if row_number == max_rows:
+                break
+            for cell in line.rstrip("\r\n").split("\t")[1:]:
+                if cell[:1] in ("{", "["):
+                    try:
+                        referenced_types.update(get_referenced_types(json.loads(cell)))
+                    except ValueError:
+                        pass
+    return referenced_types
+
+
+def get_table_dependencies(tables, referenced_types=None):
+    """Return {data table: set of data tables that must be uploaded before it}.
+
+    tables maps each load file path to its (load file type, entity type, column names). A table depends on the
+    tables of any other entity type in the batch that it references: the base type of a *_set table, the member
+    column of a membership table, any column named after another entity type, and the entity types in
+    referenced_types, an optional {data table: entity types its values reference}. Membership tables also wait for
+    the entity table of their set type. References to entity types not in the batch are assumed to already exist.
+    """
+    tables_by_type = {}
+    for data_table, (load_type, entity_type, columns) in tables.items():
+        tables_by_type.setdefault(entity_type, []).append(data_table)
+
+    dependencies = {}
+    for data_table, (load_type, entity_type, columns) in tables.items():
+        table_referenced_types = set(referenced_types.get(data_table, ()) if referenced_types else ())
+        if entity_type.endswith("_set"):
+            table_referenced_types.add(entity_type[:-len("_set")])
+        for column in columns:
+            table_referenced_types.add(column[:-len("_id")] if column.endswith("_id") else column)
+        table_referenced_types.discard(entity_type)
+
+        dependencies[data_table] = {dependency for referenced_type in table_referenced_types
+                                    for dependency in tables_by_type.get(referenced_type, [])}
+        if load_type == "membership":
+            dependencies[data_table].update(table for table in tables_by_type[entity_type]
+                                            if tables[table][0] != "membership")
+
+    return dependencies
+
+
+def run_in_dependency_order(tables, dependencies, run, max_tables=DEFAULT_MAX_TABLES):
+    """Call run(table) for every table, up to max_tables at the same time, in dependency order.
+
+    dependencies maps each table to the set of tables that must be done before it starts, as returned by
+    get_table_dependencies. run returns a tuple starting with (rows done, rows failed). A table is only done if run
+    didn't raise and failed no rows, and tables are started in the order they are listed once their dependencies are
+    done. Tables depending on a table that isn't done are skipped.
+
+    Returns ({table: what run returned, or None if it raised or was skipped}, {skipped table: the tables it was waiting on}).
+    """
+    pending = list(tables)
+    finished = set()
+    results = {}
+    skipped = {}
+    with ThreadPoolExecutor(max_workers=max_tables) as executor:
+        running = {}
+        while pending or running:
+            # start every table whose dependencies have all been done, in the order they were listed
+            for table in [table for table in pending if dependencies[table] <= finished]:
+                pending.remove(table)
+                running[executor.submit(run, table)] = table
+
+            if not running:
+                # nothing can start: the remaining tables depend on a failed table or on each other
+                for table in pending:
+                    skipped[table] = ", ".join(sorted(dependencies[table] - finished))
+                    print(f"Skipping {table}, it depends on tables that failed or have failed rows: {skipped[table]}")
+                    results[table] = None
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                table = running.pop(future)
+                try:
+                    results[table] = future.result()
+                except Exception as e:
+                    print(f"{table} failed: {e}")
+                    results[table] = None
+                    continue
+                # tables depending on this one only start if all of its rows were done
+                if results[table][1] == 0:
+                    finished.add(table)
+
+    return results, skipped
+
+
+def import_large_tsvs(tsv, project, workspace, max_tables=DEFAULT_MAX_TABLES, max_uploads=DEFAULT_MAX_UPLOADS):
+    """Import all load files listed in the input tsv file.
+
+    Up to max_tables load files are uploaded at the same time, with at most max_uploads upload requests in flight
+    across all of them. A load file is only started once every table it references has been uploaded without any
+    failed rows; load files depending on a table that failed are skipped and listed in the summary.
+    """
 
     with open(tsv, 'r') as load_files:
-        load_tsvs = [line.rstrip() for line in load_files]
-        for data_table in load_tsvs:
-            print(f"Starting upload of data table at path: {data_table}")
-            upload_tsv_to_workspace(data_table, project, workspace)
+        load_tsvs = [line.rstrip() for line in load_files if line.strip()]
+
+    tables = {data_table: read_table_header(data_table) for data_table in load_tsvs}
+    referenced_types = {data_table: read_referenced_types(data_table) for data_table, (load_type, _, _) in tables.items()
+                        if load_type == "entity"}
+    dependencies = get_table_dependencies(tables, referenced_types)
+    upload_slots = threading.BoundedSemaphore(max_uploads)
+
+    def upload(data_table):
+        print(f"Starting upload of data table at path: {data_table}")
+        start = time.time()
+        uploaded, failed = upload_tsv_to_workspace(data_table, project, workspace, workers=max_uploads, upload_slots=upload_slots)
+        return uploaded, failed, time.time() - start
+
+    summary, skipped = run_in_dependency_order(load_tsvs, dependencies, upload, max_tables)
+
+    print("Upload summary:")
+    for data_table in load_tsvs:
+        if data_table in skipped:
+            print(f"\t{data_table}: skipped, depends on tables with failed rows or that were not uploaded: {skipped[data_table]}")
+        elif summary[data_table] is None:
+            print(f"\t{data_table}: not uploaded")
+        else:
+            uploaded, failed, seconds = summary[data_table]
+            print(f"\t{data_table}: {uploaded} rows uploaded, {failed} rows failed in {seconds:.1f}s "
+                  f"({uploaded / max(seconds, 0.001):.0f} rows/s)")
 
 
 if __name__ == "__main__":
@@ -20,7 +182,13 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--tsv', type=str, required=True, help='path to new line delimited file with paths to data table load file (tsv).')
     parser.add_argument('-p-', '--project', type=str, action='store', required=True, help='Terra namespace/project of workspace.')
     parser.add_argument('-w', '--workspace', type=str, action='store', required=True, help='Name of Terra workspace.')
+    parser.add_argument('-m', '--max_tables', type=int, default=DEFAULT_MAX_TABLES, help='Number of data tables to upload at the same time.')
+    parser.add_argument('-n', '--max_uploads', type=int, default=DEFAULT_MAX_UPLOADS, help='Number of upload requests in flight across all data tables.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
 
-    args = parser.parse_args()
-    import_large_tsvs(args.tsv, args.project, args.workspace)
+    add_metrics_arguments(parser)
 
+    args = parser.parse_args()
+    configure_client(args.max_uploads, args.requests_per_second)
+    with reporting(args):
+        import_large_tsvs(args.tsv, args.project, args.workspace, args.max_tables, args.max_uploads)
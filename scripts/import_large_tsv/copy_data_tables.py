@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Copy the data tables of one Terra workspace to another without staging them on local disk."""
+import argparse
+import math
+import threading
+import time
+from bulk_import_large_tsvs import (DEFAULT_MAX_TABLES, DEFAULT_MAX_UPLOADS, DEPENDENCY_SAMPLE_ROWS, get_referenced_types,
+                                    get_table_dependencies, run_in_dependency_order)
+from common import DEFAULT_REQUESTS_PER_SECOND, configure_client
+from concurrent.futures import ThreadPoolExecutor
+from export_large_tsv.export_large_tsv import DEFAULT_CONCURRENCY, DEFAULT_PAGE_SIZE, format_tsv_value, get_entity_by_page, get_entity_types, iter_entity_pages
+from import_large_tsv import DEFAULT_CHUNK_BYTES, DEFAULT_MAX_CHUNK_ROWS, ChunkSizer, GroupedChunkUploader
+from metrics import add_metrics_arguments, reporting
+
+def get_member_attribute(entity_type, attributes):
+    """Return the name of the attribute listing the members of a set entity (e.g. "samples" of a sample_set), or None."""
+    if not entity_type.endswith("_set"):
+        return None
+    member_attribute = entity_type[:-len("_set")] + "s"
+    value = attributes.get(member_attribute)
+    if isinstance(value, dict) and value.get("itemsType") == "EntityReference":
+        return member_attribute
+    return None
+
+
+def read_page_referenced_types(project, workspace, entity_type, max_rows=DEPENDENCY_SAMPLE_ROWS):
+    """Return the entity types referenced by the attributes of the first max_rows entities of a data table.
+
+    References can be in attributes with any name (e.g. case_sample in a pair table), so the attribute names
+    alone don't show which tables a table references.
+    """
+    page_response = get_entity_by_page(project, workspace, entity_type, 1, max_rows)
+    return {referenced_type for entity_json in page_response["results"]
+            for value in entity_json["attributes"].values() for referenced_type in get_referenced_types(value)}
+
+
+def copy_data_table(source_project, source_workspace, project, workspace, entity_type, entity_type_json, upload_slots,
+                    page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, max_uploads=DEFAULT_MAX_UPLOADS,
+                    chunk_bytes=DEFAULT_CHUNK_BYTES, max_rows=DEFAULT_MAX_CHUNK_ROWS):
+    """Stream a data table from the source workspace straight into upload chunks for the destination workspace.
+
+    Rows are grouped by the columns they have values in, so a missing attribute is left missing rather than set to
+    an empty string, and the members of set entities are uploaded as membership rows. Chunks are buffered and sent
+    by a GroupedChunkUploader: once max_uploads chunks of this table are in flight, reading pages waits for one to
+    finish, so memory use stays bounded whatever the size or sparsity of the table.
+
+    Returns (rows uploaded, rows failed), counting each set membership as a row.
+    """
+    id_name = entity_type_json["idName"]
+    member_type = entity_type[:-len("_set")] if entity_type.endswith("_set") else None
+    num_pages = int(math.ceil(float(entity_type_json["count"]) / page_size))
+    sizer = ChunkSizer(chunk_bytes)
+
+    with ThreadPoolExecutor(max_workers=max_uploads) as executor:
+        uploader = GroupedChunkUploader(project, workspace, executor, sizer, max_rows, max_uploads, upload_slots)
+        page_responses = iter_entity_pages(source_project, source_workspace, entity_type, range(1, num_pages + 1), page_size, concurrency)
+        for page, page_response in page_responses:
+            for entity_json in page_response["results"]:
+                name = entity_json["name"]
+                attributes = entity_json["attributes"]
+                member_attribute = get_member_attribute(entity_type, attributes)
+                if member_attribute is not None:
+                    membership_header = f"membership:{id_name}\t{member_type}\n".encode("utf-8")
+                    for member in attributes[member_attribute]["items"]:
+                        uploader.add_row(membership_header, f"{name}\t{member['entityName']}\n".encode("utf-8"))
+
+                columns = sorted(column for column in attributes if column != member_attribute)
+                header = "\t".join([f"entity:{id_name}"] + columns).encode("utf-8") + b"\n"
+                values = [name] + [format_tsv_value(attributes[column]) for column in columns]
+                uploader.add_row(header, "\t".join(values).encode("utf-8") + b"\n")
+
+        return uploader.flush()
+
+
+def copy_data_tables(source_project, source_workspace, project, workspace, entity_types=None, max_tables=DEFAULT_MAX_TABLES,
+                     max_uploads=DEFAULT_MAX_UPLOADS, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Copy the given data tables (default all) of the source workspace to the destination workspace.
+
+    Up to max_tables tables are copied at the same time, with at most max_uploads upload requests in flight across
+    all of them. A table is only started once every table it references (e.g. the sample table of a sample_set
+    table, or the tables referenced in its first page of entities) has been copied without failed rows.
+    """
+    entity_types_json = get_entity_types(source_project, source_workspace)
+    if entity_types is None:
+        entity_types = sorted(entity_types_json)
+    missing_types = [entity_type for entity_type in entity_types if entity_type not in entity_types_json]
+    if missing_types:
+        print(f"There are no {', '.join(missing_types)} tables in {source_project}/{source_workspace}.")
+        exit(1)
+
+    tables = {entity_type: ("entity", entity_type, entity_types_json[entity_type]["attributeNames"]) for entity_type in entity_types}
+    referenced_types = {entity_type: read_page_referenced_types(source_project, source_workspace, entity_type)
+                        for entity_type in entity_types if entity_types_json[entity_type]["count"]}
+    dependencies = get_table_dependencies(tables, referenced_types)
+    upload_slots = threading.BoundedSemaphore(max_uploads)
+
+    def copy(entity_type):
+        print(f"Starting copy of {entity_types_json[entity_type]['count']} {entity_type}(s).")
+        start = time.time()
+        uploaded, failed = copy_data_table(source_project, source_workspace, project, workspace, entity_type,
+                                           entity_types_json[entity_type], upload_slots, page_size, concurrency, max_uploads)
+        print(f"Finished copy of {entity_type}.")
+        return uploaded, failed, time.time() - start
+
+    summary, skipped = run_in_dependency_order(entity_types, dependencies, copy, max_tables)
+
+    print("Copy summary:")
+    for entity_type in entity_types:
+        if entity_type in skipped:
+            print(f"\t{entity_type}: skipped, depends on tables that failed or have failed rows: {skipped[entity_type]}")
+        elif summary[entity_type] is None:
+            print(f"\t{entity_type}: not copied")
+        else:
+            uploaded, failed, seconds = summary[entity_type]
+            print(f"\t{entity_type}: {uploaded} rows uploaded, {failed} rows failed in {seconds:.1f}s "
+                  f"({uploaded / max(seconds, 0.001):.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Copies the data tables of one Terra workspace to another.")
+    # application arguments
+    parser.add_argument('--source_project', type=str, required=True, help='Terra namespace/project of the workspace to copy from.')
+    parser.add_argument('--source_workspace', type=str, required=True, help='Name of the Terra workspace to copy from.')
+    parser.add_argument('-p-', '--project', type=str, required=True, help='Terra namespace/project of the workspace to copy to.')
+    parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of the Terra workspace to copy to.')
+    parser.add_argument('-e', '--entity_types', nargs='+', help='Data tables to copy (default: all).')
+    parser.add_argument('-m', '--max_tables', type=int, default=DEFAULT_MAX_TABLES, help='Number of data tables to copy at the same time.')
+    parser.add_argument('-n', '--max_uploads', type=int, default=DEFAULT_MAX_UPLOADS, help='Number of upload requests in flight across all data tables.')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to read per page.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of pages to request in parallel per data table.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    configure_client(args.max_uploads + args.max_tables * args.concurrency, args.requests_per_second)
+    with reporting(args):
+        copy_data_tables(args.source_project, args.source_workspace, args.project, args.workspace, args.entity_types,
+                         args.max_tables, args.max_uploads, args.page_size, args.concurrency)
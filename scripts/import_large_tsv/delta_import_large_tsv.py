@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Upload only the rows of a local tsv that are new or changed compared to the same data table in a Terra workspace."""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+from tqdm import tqdm
+
+from bulk_import_large_tsvs import read_table_header
+from common import DEFAULT_REQUESTS_PER_SECOND, configure_client, hash64
+from export_large_tsv.export_large_tsv import DEFAULT_CONCURRENCY, DEFAULT_PAGE_SIZE, get_entity_types, iter_entity_pages
+from import_large_tsv import DEFAULT_WORKERS, upload_tsv_to_workspace
+from metrics import add_metrics_arguments, reporting
+
+COMPARE_BATCH_SIZE = 100000
+
+
+def canonical_tsv_value(value):
+    """Return the form of a tsv cell used for comparison, with json lists and objects normalized."""
+    if value[:1] in ("[", "{"):
+        try:
+            return json.dumps(json.loads(value), sort_keys=True, separators=(",", ":"))
+        except ValueError:
+            pass
+    return value
+
+
+def canonical_attribute_value(value):
+    """Return the form of an attribute from the entity API used for comparison with a tsv cell.
+
+    References are written as {"entityName", "entityType"} json and lists as a json list, the way a load file
+    uploaded with the flexible model has to hold them, and normalized like canonical_tsv_value. A tsv cell with a
+    bare entity name therefore doesn't match a reference, since uploading it would store a string. Values that
+    still don't compare equal (e.g. 1.0 and 1) are only ever re-uploaded, never skipped.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, dict):
+        if "items" in value:
+            value = value["items"]
+        return json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return str(value)
+
+
+class RowIndex:
+    """Sorted 64-bit hashes of the entity names and row values of a data table.
+
+    keys and row_hashes are sorted by key and take 16 bytes per entity. order maps each sorted position back to the
+    position of the entity in names_path, a file with one entity name per line used to report deleted entities.
+    Two different entity names sharing a 64-bit hash is possible but vanishingly unlikely for tables of this size.
+    """
+
+    def __init__(self, entity_type, columns, keys, row_hashes, order, names_path):
+        self.entity_type = entity_type
+        self.columns = columns
+        self.keys = keys
+        self.row_hashes = row_hashes
+        self.order = order
+        self.names_path = names_path
+
+    @classmethod
+    def build(cls, project, workspace, entity_type, columns, names_path, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        """Build the index by streaming the data table from the workspace, hashing the given columns of each row."""
+        keys = array("Q")
+        row_hashes = array("Q")
+
+        entity_types_json = get_entity_types(project, workspace)
+        entity_count = entity_types_json[entity_type]["count"] if entity_type in entity_types_json else 0
+        num_pages = int(math.ceil(float(entity_count) / page_size))
+
+        print(f'Indexing {entity_count} {entity_type}(s) in {project}/{workspace}.')
+        with open(names_path, "w") as names:
+            page_responses = iter_entity_pages(project, workspace, entity_type, range(1, num_pages + 1), page_size, concurrency)
+            for page, page_response in tqdm(page_responses, total=num_pages):
+                for entity_json in page_response["results"]:
+                    attributes = entity_json["attributes"]
+                    keys.append(hash64(entity_json["name"]))
+                    row_hashes.append(hash64("\t".join(canonical_attribute_value(attributes.get(column)) for column in columns)))
+                    names.write(entity_json["name"] + "\n")
+
+        keys = np.frombuffer(keys, dtype=np.uint64)
+        order = np.argsort(keys, kind="stable")
+        return cls(entity_type, columns, keys[order], np.frombuffer(row_hashes, dtype=np.uint64)[order], order, names_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """Load an index written by save()."""
+        with np.load(index_path) as index:
+            metadata = json.loads(str(index["metadata"]))
+            return cls(metadata["entity_type"], metadata["columns"], index["keys"], index["row_hashes"], index["order"],
+                       index_path + ".names")
+
+    def save(self, index_path):
+        """Save the index to index_path, with the entity names next to it in index_path.names."""
+        metadata = json.dumps({"entity_type": self.entity_type, "columns": self.columns})
+        with open(index_path, "wb") as index_file:
+            np.savez(index_file, keys=self.keys, row_hashes=self.row_hashes, order=self.order, metadata=np.array(metadata))
+        if os.path.abspath(self.names_path) != os.path.abspath(index_path + ".names"):
+            shutil.copyfile(self.names_path, index_path + ".names")
+        print(f'Saved index of {len(self.keys)} {self.entity_type}(s) to {index_path}.')
+
+    def lookup(self, keys):
+        """Return the sorted positions of the given keys, and a mask of which keys are in the index."""
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return positions, found
+
+
+def write_delta_tsv(tsv, index, delta_tsv):
+    """Write the header and every row of tsv that is new or changed compared to the index to delta_tsv.
+
+    Returns (rows written, boolean mask over the index of the entities that are also in the tsv).
+    """
+    seen = np.zeros(len(index.keys), dtype=bool)
+    delta_rows = 0
+
+    def compare(lines, keys, row_hashes):
+        positions, found = index.lookup(np.array(keys, dtype=np.uint64))
+        unchanged = found.copy()
+        unchanged[found] = index.row_hashes[positions[found]] == np.array(row_hashes, dtype=np.uint64)[found]
+        seen[positions[found]] = True
+        changed_lines = [line for line, is_unchanged in zip(lines, unchanged) if not is_unchanged]
+        deltaout.writelines(changed_lines)
+        return len(changed_lines)
+
+    with open(tsv, "r") as tsvfile, open(delta_tsv, "w") as deltaout:
+        deltaout.write(tsvfile.readline())
+        lines, keys, row_hashes = [], [], []
+        for line in tqdm(tsvfile, unit=" rows"):
+            values = line.rstrip("\r\n").split("\t")
+            lines.append(line)
+            keys.append(hash64(values[0]))
+            row_hashes.append(hash64("\t".join(canonical_tsv_value(value) for value in values[1:])))
+            if len(lines) == COMPARE_BATCH_SIZE:
+                delta_rows += compare(lines, keys, row_hashes)
+                lines, keys, row_hashes = [], [], []
+
+        if lines:
+            delta_rows += compare(lines, keys, row_hashes)
+
+    return delta_rows, seen
+
+
+def write_deleted_report(index, seen, report_path):
+    """Write the names of the indexed entities that are not in the tsv, one per line, and return how many there are."""
+    # the names file is in the order the entities were indexed, not in sorted key order
+    deleted = np.zeros(len(index.keys), dtype=bool)
+    deleted[index.order[~seen]] = True
+
+    with open(index.names_path, "r") as names, open(report_path, "w") as report:
+        for is_deleted, name in zip(deleted, names):
+            if is_deleted:
+                report.write(name)
+
+    return int(deleted.sum())
+
+
+def delta_upload_tsv_to_workspace(tsv, project, workspace, index_path=None, save_index_path=None, deleted_report=None,
+                                  delta_tsv=None, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, workers=DEFAULT_WORKERS):
+    """Upload the rows of a tsv that are new or changed compared to the workspace.
+
+    The rows in the workspace are read from a previously saved index at index_path, or indexed by exporting the
+    data table. The new and changed rows are written to delta_tsv (default <tsv>.delta.tsv), which is then uploaded
+    with upload_tsv_to_workspace.
+    """
+    load_type, entity_type, columns = read_table_header(tsv)
+    if load_type != "entity":
+        print(f"Delta imports are only supported for entity load files, {tsv} is a {load_type} load file.")
+        exit(1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if index_path is not None:
+            index = RowIndex.load(index_path)
+            if index.entity_type != entity_type or index.columns != columns:
+                print(f"The index at {index_path} was built for {index.entity_type} columns {index.columns}, which don't "
+                      f"match {tsv}. Run without --index to rebuild it.")
+                exit(1)
+        else:
+            index = RowIndex.build(project, workspace, entity_type, columns, os.path.join(tmpdir, "names"), page_size, concurrency)
+            if save_index_path is not None:
+                index.save(save_index_path)
+
+        if delta_tsv is None:
+            delta_tsv = tsv + ".delta.tsv"
+        print(f'Comparing {tsv} to {len(index.keys)} {entity_type}(s) in the workspace.')
+        delta_rows, seen = write_delta_tsv(tsv, index, delta_tsv)
+        print(f'{delta_rows} new or changed {entity_type}(s) written to {delta_tsv}.')
+
+        if deleted_report is not None:
+            deleted_count = write_deleted_report(index, seen, deleted_report)
+            print(f'{deleted_count} {entity_type}(s) in the workspace but not in {tsv} written to {deleted_report}.')
+
+    if delta_rows:
+        upload_tsv_to_workspace(delta_tsv, project, workspace, workers=workers)
+    else:
+        print("No new or changed rows to upload.")
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Imports/uploads only the new or changed rows of a TSV file to a Terra data table.")
+    # application arguments
+    parser.add_argument('-p-', '--project', type=str, action='store', required=True, help='Terra namespace/project of workspace.')
+    parser.add_argument('-w', '--workspace', type=str, action='store', required=True, help='Name of Terra workspace.')
+    parser.add_argument('-t', '--tsv', type=str, action='store', required=True, help='Path to local tsv file to upload.')
+    parser.add_argument('-i', '--index', type=str, help='Path to a previously saved index of the data table to compare against, instead of exporting it from the workspace.')
+    parser.add_argument('-s', '--save_index', type=str, help='Path to save the index built from the workspace to, for use with --index.')
+    parser.add_argument('-d', '--deleted_report', type=str, help='Path to write the names of entities in the workspace that are not in the tsv to.')
+    parser.add_argument('-o', '--delta_tsv', type=str, help='Path to write the new and changed rows to before uploading (default <tsv>.delta.tsv).')
+    parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to export per page when building the index.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of pages to request in parallel when building the index.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of chunks to upload in parallel.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    configure_client(max(args.concurrency, args.workers), args.requests_per_second)
+    with reporting(args):
+        delta_upload_tsv_to_workspace(args.tsv, args.project, args.workspace, args.index, args.save_index, args.deleted_report,
+                                      args.delta_tsv, args.page_size, args.concurrency, args.workers)
@@ -1,44 +1,372 @@
 # -*- coding: utf-8 -*-
 """Upload a local tsv to a Terra workspace data model when it is too large to import using the Terra UI."""
 import argparse
+import contextlib
+import hashlib
+import json
+import os
+import requests
+import tenacity as tn
+import threading
+import time
+from common import DEFAULT_REQUESTS_PER_SECOND, TIMEOUT_CODES, BoundedSubmitter, call_fiss, configure_client, is_retryable_at_same_size
+from concurrent.futures import ThreadPoolExecutor
 from firecloud import api as fapi
+from firecloud import errors as ferrors
+from metrics import add_metrics_arguments, metrics, reporting
 from tqdm import tqdm
 
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+MIN_CHUNK_BYTES = 64 * 1024
+MAX_CHUNK_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_CHUNK_ROWS = 50000
+DEFAULT_TARGET_LATENCY = 30
+DEFAULT_WORKERS = 4
+# partial chunks of all combinations of columns together are kept under this many times the upload chunk size
+MAX_BUFFERED_CHUNKS = 2
 
-def upload_tsv_to_workspace(tsv, project, workspace):
-    """Split large TSV file and upload individual smaller TSV files to Terra workspace."""
-    # initiate list that will contain n items where each n = header + 5000 rows of input tsv data
-    tsv_strings = []
 
-    # open input tsv, save header, split large tsv into 5000 row chunks, upload each 5000 chunk to Terra via API
-    with open(tsv, "r") as tsvfile:
-        # save header from input tsv (entity:table-name_id, col1, col2, col3, ...)
-        header = tsvfile.readline()
-        # initiate tsv_subset variable with header - 5000 rows of data to be added to tsv_subset
-        tsv_subset = header
+class ChunkSizer:
+    """Thread-safe target payload size for upload chunks, adjusted from the outcome of each upload.
 
-        # loop through input tsv, check for 5000 rows, add to tsv_subset (already contains header)
-        for i, line in enumerate(tsvfile):
-            # add row by row to tsv_subset
-            tsv_subset += line
+    The target grows while full-sized chunks upload well under target_latency seconds, shrinks in proportion
+    when uploads take longer than target_latency, and is halved whenever an upload is rejected as too large
+    or times out.
+    """
 
-            # add until rows = 5000
-            if i > 0 and i % 5000 == 0:
-                # for each tsv_subset (header + 5000 rows) append to tsv_strings
-                tsv_strings.append(tsv_subset)
-                # reset tsv_subset to be only header
-                tsv_subset = header
+    def __init__(self, target_bytes=DEFAULT_CHUNK_BYTES, target_latency=DEFAULT_TARGET_LATENCY,
+                 min_bytes=MIN_CHUNK_BYTES, max_bytes=MAX_CHUNK_BYTES):
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.min_bytes = min_bytes
+        self.max_bytes = max(max_bytes, target_bytes)
+        self._lock = threading.Lock()
 
-        # catch the last lines from the tsv file that aren't caught by the % above
-        tsv_strings.append(tsv_subset)
+    def _set_target(self, target_bytes):
+        self.target_bytes = int(min(self.max_bytes, max(self.min_bytes, target_bytes)))
 
-        # for each chunk of 5000 rows(tsv_string) in tsv_strings, upload using API call
-        for tsv_string in tqdm(tsv_strings):
-            request = fapi.upload_entities(project, workspace, tsv_string, model='flexible')
-            if request.status_code != 200:
-                print(request.text)
+    def record_success(self, num_bytes, latency):
+        """Adjust the target after a chunk of num_bytes uploaded in latency seconds."""
+        with self._lock:
+            if latency > self.target_latency:
+                self._set_target(self.target_bytes * max(0.5, self.target_latency / latency))
+            elif latency < self.target_latency / 2 and num_bytes >= 0.8 * self.target_bytes:
+                # only grow on chunks that were close to the target, small trailing chunks say nothing about the limit
+                self._set_target(self.target_bytes * 1.25)
 
-    print("Upload of entities complete.")
+    def record_failure(self):
+        """Halve the target after a chunk was too large for the server to accept in time."""
+        with self._lock:
+            self._set_target(self.target_bytes / 2)
+
+
+def iter_tsv_chunks(tsvfile, sizer, max_rows=DEFAULT_MAX_CHUNK_ROWS, planned_chunks=()):
+    """Read an open binary tsv file in a single pass and yield (header, rows, start, end) for each chunk.
+
+    start and end are the byte offsets of the chunk's rows in the file. Rows are added to a chunk until it
+    reaches the sizer's current target payload size in bytes, or max_rows. The target is read again for every
+    chunk, so adjustments made by in-flight uploads apply to the next chunk.
+
+    planned_chunks is an optional collection of (start, end) offsets, e.g. from an upload journal. Chunks are cut at
+    exactly those offsets where the file still lines up with them, and sized as above everywhere else.
+    """
+    # save header from input tsv (entity:table-name_id, col1, col2, col3, ...)
+    header = tsvfile.readline()
+    position = len(header)
+
+    planned = iter(sorted(planned_chunks))
+    next_planned = next(planned, None)
+
+    rows = []
+    for line in tsvfile:
+        if not rows:
+            chunk_start = position
+            chunk_bytes = len(header)
+            # drop planned chunks this line has already passed, which happens if the tsv changed since they were planned
+            while next_planned is not None and next_planned[0] < position:
+                next_planned = next(planned, None)
+            planned_end = None
+            if next_planned is not None and next_planned[0] == position:
+                planned_end = next_planned[1]
+                next_planned = next(planned, None)
+
+        rows.append(line)
+        position += len(line)
+        chunk_bytes += len(line)
+        if planned_end is not None:
+            chunk_complete = position >= planned_end
+        else:
+            chunk_complete = (chunk_bytes >= sizer.target_bytes or len(rows) == max_rows
+                              or (next_planned is not None and position >= next_planned[0]))
+        if chunk_complete:
+            yield header, rows, chunk_start, position
+            rows = []
+
+    # catch the last lines from the tsv file that don't fill a whole chunk
+    if rows:
+        yield header, rows, chunk_start, position
+
+
+def get_journal_path(tsv, project, workspace):
+    """Return the path of the upload journal kept next to a tsv for uploads to the given workspace."""
+    return f"{tsv}.{project}.{workspace}.journal"
+
+
+def get_file_identity(tsv, project, workspace):
+    """Return the destination workspace, and the path, size and modification time that identify the version of a
+    tsv, that a journal was written for."""
+    stat = os.stat(tsv)
+    return {"project": project, "workspace": workspace, "file": os.path.abspath(tsv), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def get_chunk_hash(header, rows):
+    """Return the sha256 of a chunk's header + rows payload."""
+    chunk_hash = hashlib.sha256(header)
+    for row in rows:
+        chunk_hash.update(row)
+    return chunk_hash.hexdigest()
+
+
+def read_journal(journal_path):
+    """Read an upload journal and return (file identity, {(start, end): latest record for that chunk}).
+
+    The journal is a json line per event: a file identity line whenever a run starts on a different version of the
+    tsv, then one line per uploaded chunk with its offsets, row count, content hash and status.
+    """
+    identity = None
+    records = {}
+    if not os.path.isfile(journal_path):
+        return identity, records
+
+    with open(journal_path, "r") as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a line cut short when a previous run was killed
+                continue
+            if "file" in record:
+                identity = record
+            else:
+                records[(record["start"], record["end"])] = record
+
+    return identity, records
+
+
+def is_committed(record, chunk_hash):
+    """Return True if a journal record shows this exact chunk content was uploaded successfully."""
+    return record is not None and record["status"] == "committed" and record["sha256"] == chunk_hash
+
+
+# call_fiss without retrying timed out uploads at the same size
+_call_upload = call_fiss.retry_with(retry=tn.retry_if_exception(is_retryable_at_same_size))
+
+
+def upload_rows(project, workspace, header, rows, sizer, upload_slots=None):
+    """Upload header + rows to the Terra workspace and return (rows uploaded, rows failed).
+
+    A chunk that is rejected as too large (413) is split in half and each half is retried, until the failing chunk is
+    a single row. Timeouts (the client's read timeout, 408 and 504) are not retried at the same size: the sizer's
+    target is halved and the chunk is split if it is larger than that, so a slow server shrinks chunks down to the
+    sizer's minimum at most, and a chunk that is not larger is counted as failed. A chunk that still fails on the
+    server (other 5xx) after call_fiss's retries is not split but counted as failed, so an outage doesn't multiply
+    the number of requests. A journaled upload retries failed chunks on --resume. If upload_slots is given, a slot
+    is held from it for the duration of each request.
+    """
+    with metrics.timed("build_upload_payload"):
+        tsv_bytes = header + b"".join(rows)
+        tsv_string = tsv_bytes.decode("utf-8")
+    with upload_slots if upload_slots is not None else contextlib.nullcontext():
+        start = time.time()
+        try:
+            # 413s and timeouts are returned or raised without being retried as they are, so they can be split
+            request = _call_upload(fapi.upload_entities, 200, project, workspace, tsv_string,
+                                   model='flexible', specialcodes=[413, *TIMEOUT_CODES])
+            status_code, error = request.status_code, request.text
+        except ferrors.FireCloudServerError as e:
+            status_code, error = e.code, e.message
+        except requests.ReadTimeout as e:
+            status_code, error = 408, str(e)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            status_code, error = None, str(e)
+
+    if status_code == 200:
+        sizer.record_success(len(tsv_bytes), time.time() - start)
+        metrics.record_rows("uploaded", len(rows))
+        return len(rows), 0
+
+    timed_out = status_code in TIMEOUT_CODES
+    if status_code == 413 or timed_out:
+        sizer.record_failure()
+    # a timed out chunk is only split if it is oversized for the shrunk target, a 413 is always split
+    if len(rows) > 1 and (status_code == 413 or (timed_out and len(tsv_bytes) > sizer.target_bytes)):
+        print(f"Upload of {len(rows)} rows failed ({status_code or error}), retrying as two chunks.")
+        half = len(rows) // 2
+        first_uploaded, first_failed = upload_rows(project, workspace, header, rows[:half], sizer, upload_slots)
+        second_uploaded, second_failed = upload_rows(project, workspace, header, rows[half:], sizer, upload_slots)
+        return first_uploaded + second_uploaded, first_failed + second_failed
+
+    print(error)
+    return 0, len(rows)
+
+
+class GroupedChunkUploader:
+    """Buffers rows into upload chunks by header and uploads each chunk once it is full.
+
+    A chunk is sent as soon as it reaches the sizer's target size or max_rows, and the largest partial chunk is sent
+    early whenever the partial chunks together grow past MAX_BUFFERED_CHUNKS chunk sizes, which happens when rows
+    have many different combinations of columns. Once max_uploads chunks are in flight, add_row waits for one to
+    finish, so the loop reading rows is held back and memory use stays bounded.
+    """
+
+    def __init__(self, project, workspace, executor, sizer, max_rows=DEFAULT_MAX_CHUNK_ROWS, max_uploads=DEFAULT_WORKERS,
+                 upload_slots=None):
+        self.project = project
+        self.workspace = workspace
+        self.sizer = sizer
+        self.max_rows = max_rows
+        self.upload_slots = upload_slots
+        self.uploaded_rows = 0
+        self.failed_rows = 0
+        # {header: (rows, bytes)}
+        self._chunks = {}
+        self._buffered_bytes = 0
+        self._uploads = BoundedSubmitter(executor, max_uploads, self._collect)
+
+    def _collect(self, header, result):
+        uploaded, failed = result
+        self.uploaded_rows += uploaded
+        self.failed_rows += failed
+
+    def _send(self, header):
+        rows, num_bytes = self._chunks.pop(header)
+        self._buffered_bytes -= num_bytes
+        self._uploads.submit(header, upload_rows, self.project, self.workspace, header, rows, self.sizer, self.upload_slots)
+
+    def add_row(self, header, row):
+        """Add an encoded row to the chunk for its encoded header, sending chunks as described above."""
+        rows, num_bytes = self._chunks.setdefault(header, ([], 0))
+        rows.append(row)
+        self._chunks[header] = (rows, num_bytes + len(row))
+        self._buffered_bytes += len(row)
+        if num_bytes + len(row) >= self.sizer.target_bytes or len(rows) >= self.max_rows:
+            self._send(header)
+        elif self._buffered_bytes > MAX_BUFFERED_CHUNKS * self.sizer.target_bytes:
+            self._send(max(self._chunks, key=lambda buffered_header: self._chunks[buffered_header][1]))
+
+    def flush(self):
+        """Send every partial chunk, wait for all uploads and return (rows uploaded, rows failed)."""
+        for header in list(self._chunks):
+            self._send(header)
+        self._uploads.wait_all()
+        return self.uploaded_rows, self.failed_rows
+
+
+def upload_tsv_to_workspace(tsv, project, workspace, chunk_bytes=DEFAULT_CHUNK_BYTES, workers=DEFAULT_WORKERS,
+                            max_rows=DEFAULT_MAX_CHUNK_ROWS, target_latency=DEFAULT_TARGET_LATENCY, resume=False, upload_slots=None):
+    """Split large TSV file and upload individual smaller TSV files to Terra workspace.
+
+    Chunks start at chunk_bytes and are resized during the upload based on upload latency and failures.
+    They are read from disk as they are needed and uploaded by `workers` concurrent requests, so at most
+    `workers` chunks are held in memory at any time.
+
+    If resume is True, the outcome of every chunk is recorded in a journal next to the tsv and chunks the journal
+    shows were already uploaded with the same content are skipped. upload_slots is an optional semaphore shared
+    with other uploads to limit the total number of requests in flight.
+
+    Returns (rows uploaded, rows failed).
+    """
+    sizer = ChunkSizer(chunk_bytes, target_latency)
+    num_rows = 0
+    failed_rows = 0
+    skipped_rows = 0
+
+    journal = None
+    records = {}
+    if resume:
+        journal_path = get_journal_path(tsv, project, workspace)
+        identity, records = read_journal(journal_path)
+        current_identity = get_file_identity(tsv, project, workspace)
+        journal = open(journal_path, "a")
+        if identity is not None and (identity.get("project"), identity.get("workspace")) != (project, workspace):
+            # chunks uploaded to another workspace say nothing about this one
+            print(f"{journal_path} was written for uploads to another workspace, uploading every chunk.")
+            records = {}
+        if identity != current_identity:
+            if records:
+                print(f"{tsv} changed since {journal_path} was written, previously uploaded chunks will only be skipped if their content is unchanged.")
+            journal.write(json.dumps(current_identity) + "\n")
+
+    # open input tsv, split it into chunks, upload each chunk to Terra via API as soon as a worker is free
+    with open(tsv, "rb") as tsvfile, ThreadPoolExecutor(max_workers=workers) as executor, tqdm(desc=os.path.basename(tsv), unit=" rows") as progress:
+        def collect(chunk, result):
+            nonlocal num_rows, failed_rows
+            uploaded, failed = result
+            num_rows += uploaded
+            failed_rows += failed
+            progress.update(uploaded + failed)
+            if journal is not None:
+                start, end, chunk_hash = chunk
+                journal.write(json.dumps({"start": start, "end": end, "rows": uploaded + failed, "sha256": chunk_hash,
+                                          "status": "failed" if failed else "committed"}) + "\n")
+                journal.flush()
+
+        # waits for a worker to finish before reading the next chunk so memory use stays bounded
+        uploads = BoundedSubmitter(executor, workers, collect)
+        for header, rows, start, end in iter_tsv_chunks(tsvfile, sizer, max_rows, records):
+            chunk_hash = None
+            if journal is not None:
+                chunk_hash = get_chunk_hash(header, rows)
+                if is_committed(records.get((start, end)), chunk_hash):
+                    skipped_rows += len(rows)
+                    progress.update(len(rows))
+                    continue
+            uploads.submit((start, end, chunk_hash), upload_rows, project, workspace, header, rows, sizer, upload_slots)
+
+        uploads.wait_all()
+
+    if journal is not None:
+        journal.close()
+        if skipped_rows:
+            print(f"Skipped {skipped_rows} rows already uploaded by a previous run.")
+
+    if failed_rows:
+        print(f"Upload of entities complete, {num_rows} rows uploaded and {failed_rows} rows failed to upload.")
+    else:
+        print(f"Upload of {num_rows} entities complete.")
+
+    return num_rows, failed_rows
+
+
+def verify_tsv_upload(tsv, project, workspace, chunk_bytes=DEFAULT_CHUNK_BYTES, max_rows=DEFAULT_MAX_CHUNK_ROWS):
+    """Compare a tsv against its upload journal and report the chunks that have not been uploaded.
+
+    Returns a list of (start, end, rows, status) for every chunk still missing, where status is the last
+    journal status of the chunk, or "missing" if it was never uploaded or its content changed.
+    """
+    journal_path = get_journal_path(tsv, project, workspace)
+    identity, records = read_journal(journal_path)
+    if identity is None:
+        print(f"No upload journal found at {journal_path}, run the upload with --resume to create one.")
+        return None
+
+    committed_rows = 0
+    missing_chunks = []
+    with open(tsv, "rb") as tsvfile:
+        for header, rows, start, end in iter_tsv_chunks(tsvfile, ChunkSizer(chunk_bytes), max_rows, records):
+            record = records.get((start, end))
+            if is_committed(record, get_chunk_hash(header, rows)):
+                committed_rows += len(rows)
+            else:
+                status = record["status"] if record is not None and record["status"] == "failed" else "missing"
+                missing_chunks.append((start, end, len(rows), status))
+
+    missing_rows = sum(chunk[2] for chunk in missing_chunks)
+    print(f"{committed_rows} rows uploaded, {missing_rows} rows in {len(missing_chunks)} chunk(s) still to upload.")
+    for start, end, rows, status in missing_chunks:
+        print(f"\t{status}: {rows} rows at bytes {start}-{end}")
+
+    return missing_chunks
 
 
 if __name__ == "__main__":
@@ -63,6 +391,46 @@ if __name__ == "__main__":
         action='store',
         required=True,
         help='Path to local tsv file to upload.')
+    parser.add_argument(
+        '--chunk_bytes', '-b',
+        type=int,
+        default=DEFAULT_CHUNK_BYTES,
+        help='Starting size in bytes of each upload request, adjusted during the upload.')
+    parser.add_argument(
+        '--max_rows', '-m',
+        type=int,
+        default=DEFAULT_MAX_CHUNK_ROWS,
+        help='Maximum number of rows to upload per request.')
+    parser.add_argument(
+        '--target_latency', '-l',
+        type=float,
+        default=DEFAULT_TARGET_LATENCY,
+        help='Upload time in seconds per request that chunk sizing aims to stay under.')
+    parser.add_argument(
+        '--workers', '-n',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='Number of chunks to upload in parallel.')
+    parser.add_argument(
+        '--resume', '-r',
+        action='store_true',
+        help='Record uploaded chunks in a journal next to the tsv and skip chunks a previous run already uploaded.')
+    parser.add_argument(
+        '--verify', '-v',
+        action='store_true',
+        help='Only report which chunks of the tsv the journal shows are still missing, without uploading.')
+    parser.add_argument(
+        '--requests_per_second',
+        type=float,
+        default=DEFAULT_REQUESTS_PER_SECOND,
+        help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    upload_tsv_to_workspace(args.tsv, args.project, args.workspace)
+    configure_client(args.workers, args.requests_per_second)
+    with reporting(args):
+        if args.verify:
+            verify_tsv_upload(args.tsv, args.project, args.workspace, args.chunk_bytes, args.max_rows)
+        else:
+            upload_tsv_to_workspace(args.tsv, args.project, args.workspace, args.chunk_bytes, args.workers, args.max_rows, args.target_latency, args.resume)
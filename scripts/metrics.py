@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Lightweight in-process metrics for API calls, client-side work and row throughput."""
+
+import importlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket holds everything slower
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class TimingStats:
+    """Count, latency histogram, bytes and retries for one API endpoint or client-side step."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.status_codes = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, status_code=None, bytes_sent=0, bytes_received=0, error=False):
+        self.calls += 1
+        self.errors += int(error)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        if status_code is not None:
+            self.status_codes[str(status_code)] = self.status_codes.get(str(status_code), 0) + 1
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction):
+        """Return the upper bound of the histogram bucket holding the given fraction of calls."""
+        threshold = fraction * self.calls
+        count = 0
+        for bucket, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= threshold and bucket_count:
+                return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else self.max_seconds
+        return None
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "total_seconds": round(self.total_seconds, 3),
+            "mean_seconds": round(self.total_seconds / self.calls, 4) if self.calls else None,
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "p99_seconds": self.percentile(0.99),
+            "max_seconds": round(self.max_seconds, 4),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "status_codes": self.status_codes,
+            "histogram": {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, self.histogram)},
+            "histogram_overflow": self.histogram[-1],
+        }
+
+
+class Metrics:
+    """Thread-safe collection of API call, client-side step and row metrics for one run.
+
+    Every recorded event is also passed as a dict to each hook added with add_hook, e.g. to forward it to a
+    monitoring system. A failing hook is logged and otherwise ignored.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.endpoints = {}
+        self.steps = {}
+        self.rows = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def _emit(self, event):
+        for hook in self._hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception('Metrics hook %s failed', hook)
+
+    def record_call(self, endpoint, seconds, status_code=None, bytes_sent=0, bytes_received=0, error=False):
+        """Record one API call to endpoint."""
+        with self._lock:
+            self.endpoints.setdefault(endpoint, TimingStats()).add(seconds, status_code, bytes_sent, bytes_received, error)
+        self._emit({"type": "call", "endpoint": endpoint, "seconds": seconds, "status_code": status_code,
+                    "bytes_sent": bytes_sent, "bytes_received": bytes_received, "error": error})
+
+    def record_retry(self, endpoint):
+        """Record that a call to endpoint is about to be retried."""
+        with self._lock:
+            self.endpoints.setdefault(endpoint, TimingStats()).retries += 1
+        self._emit({"type": "retry", "endpoint": endpoint})
+
+    def record_rows(self, name, count):
+        """Add count rows to the named row counter, e.g. "exported" or "uploaded"."""
+        with self._lock:
+            self.rows[name] = self.rows.get(name, 0) + count
+        self._emit({"type": "rows", "name": name, "count": count})
+
+    @contextmanager
+    def timed(self, step):
+        """Time a client-side step, e.g. building an upload payload or writing a page to disk."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.steps.setdefault(step, TimingStats()).add(seconds)
+            self._emit({"type": "step", "step": step, "seconds": seconds})
+
+    def report(self):
+        """Return all metrics collected so far as a json-serializable dict."""
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {
+                "elapsed_seconds": round(elapsed, 3),
+                "endpoints": {endpoint: stats.to_dict() for endpoint, stats in self.endpoints.items()},
+                "steps": {step: stats.to_dict() for step, stats in self.steps.items()},
+                "rows": {name: {"count": count, "per_second": round(count / elapsed, 1) if elapsed else None}
+                         for name, count in self.rows.items()},
+            }
+
+    def write_json(self, path):
+        """Write the metrics report to a json file."""
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        print(f"Wrote metrics to {path}")
+
+
+def load_hook(hook_path):
+    """Import a metrics hook given as "module:function", e.g. "my_monitoring:send_event"."""
+    module_name, _, function_name = hook_path.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def add_metrics_arguments(parser):
+    """Add the --metrics_json and --metrics_hook arguments every script takes to an argparse parser."""
+    parser.add_argument('--metrics_json', type=str, help='Path to write a json report of API latencies, bytes, retries and rows/sec to.')
+    parser.add_argument('--metrics_hook', type=str, help='Function to pass every metrics event to, as module:function.')
+
+
+@contextmanager
+def reporting(args):
+    """Pass metrics events to args.metrics_hook during the block and write the args.metrics_json report after it,
+    also when the block fails."""
+    if args.metrics_hook:
+        metrics.add_hook(load_hook(args.metrics_hook))
+    try:
+        yield metrics
+    finally:
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+
+
+# metrics for the current process, shared by every script and module
+metrics = Metrics()
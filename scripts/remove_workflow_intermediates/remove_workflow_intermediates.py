@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""Find and delete the workflow intermediate files in a Terra workspace bucket that nothing in the workspace references."""
+import argparse
+import math
+import queue
+import sys
+import threading
+from array import array
+from common import DEFAULT_REQUESTS_PER_SECOND, BoundedSubmitter, call_fiss, configure_client, get_storage_client, hash64
+from concurrent.futures import ThreadPoolExecutor
+from export_large_tsv.export_large_tsv import DEFAULT_CONCURRENCY, DEFAULT_PAGE_SIZE, get_entity_types, iter_entity_pages
+from firecloud import api as fapi
+from fnmatch import fnmatchcase
+from google.api_core import exceptions as gexceptions
+from metrics import add_metrics_arguments, metrics, reporting
+from tqdm import tqdm
+import numpy as np
+
+DEFAULT_LIST_WORKERS = 8
+DEFAULT_DELETE_WORKERS = 8
+# the most requests a single storage batch request can hold
+DELETE_BATCH_SIZE = 100
+LOOKUP_BATCH_SIZE = 100000
+# files Cromwell writes next to every task that are kept for debugging, as in fissfc mop
+KEEP_FILE_NAMES = ("rc", "memory_retry_rc", "exec.sh", "script", "stderr", "stdout", "output",
+                   "gcs_localization.sh", "gcs_delocalization.sh", "gcs_transfer.sh")
+
+
+def add_referenced_files(referenced, values, bucket_prefix):
+    """Add the hash of every path in the bucket found in attribute values, lists and nested json to referenced."""
+    for value in values:
+        if isinstance(value, dict) and value.get("itemsType") == "AttributeValue":
+            add_referenced_files(referenced, value["items"], bucket_prefix)
+        elif isinstance(value, dict):
+            add_referenced_files(referenced, value.values(), bucket_prefix)
+        elif isinstance(value, list):
+            add_referenced_files(referenced, value, bucket_prefix)
+        elif isinstance(value, str) and value.startswith(bucket_prefix):
+            referenced.append(hash64(value))
+
+
+def get_referenced_files(project, workspace, workspace_json, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """Return the sorted 64-bit hashes of every path in the workspace bucket referenced by the workspace.
+
+    References are read from the workspace attributes and from every data table, which is streamed page by page.
+    Each reference takes 8 bytes, so even tens of millions of references fit in memory. Two paths sharing a hash
+    can only cause an orphaned file to be kept, never a referenced file to be deleted.
+    """
+    bucket_prefix = f"gs://{workspace_json['bucketName']}/"
+    referenced = array("Q")
+    add_referenced_files(referenced, workspace_json["attributes"].values(), bucket_prefix)
+
+    for entity_type, entity_type_json in get_entity_types(project, workspace).items():
+        num_pages = int(math.ceil(float(entity_type_json["count"]) / page_size))
+        print(f"Reading references from {entity_type_json['count']} {entity_type}(s).")
+        page_responses = iter_entity_pages(project, workspace, entity_type, range(1, num_pages + 1), page_size, concurrency)
+        for page, page_response in tqdm(page_responses, total=num_pages):
+            for entity_json in page_response["results"]:
+                add_referenced_files(referenced, entity_json["attributes"].values(), bucket_prefix)
+
+    return np.unique(np.frombuffer(referenced, dtype=np.uint64))
+
+
+def iter_bucket_files(bucket_name, prefixes, workers=DEFAULT_LIST_WORKERS):
+    """Yield (path, size) of every file in the bucket under any of the prefixes.
+
+    Prefixes are listed by `workers` threads at once. Listed pages are handed over through a bounded queue, so a
+    listing that runs ahead of the caller waits rather than filling memory. If the caller stops reading, e.g.
+    because it raised, the listing threads stop too.
+    """
+    client = get_storage_client()
+    pages = queue.Queue(maxsize=2 * workers)
+    done = object()
+    cancelled = threading.Event()
+
+    def put(item):
+        # a blocking put would wait forever on a full queue once the caller has stopped reading
+        while not cancelled.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_prefix(prefix):
+        try:
+            blobs = client.list_blobs(bucket_name, prefix=prefix, fields="items(name,size),nextPageToken")
+            for page in blobs.pages:
+                if not put([(f"gs://{bucket_name}/{blob.name}", int(blob.size)) for blob in page]):
+                    return
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+            remaining = len(futures)
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                else:
+                    yield from page
+            # raise the first listing error, if any
+            for future in futures:
+                future.result()
+        finally:
+            cancelled.set()
+
+
+def can_delete(path, include=None, exclude=None):
+    """Return True if an unreferenced file may be deleted: logs, return codes and task scripts are always kept.
+
+    If include is given only file names matching one of its globs are deleted, and file names matching a glob in
+    exclude are never deleted.
+    """
+    file_name = path.rsplit("/", 1)[-1]
+    if file_name.endswith(".log") or file_name.endswith("-rc.txt") or file_name in KEEP_FILE_NAMES:
+        return False
+    if include:
+        return any(fnmatchcase(file_name, glob) for glob in include)
+    if exclude:
+        return not any(fnmatchcase(file_name, glob) for glob in exclude)
+    return True
+
+
+def format_size(num_bytes):
+    """Return a size in bytes in human readable units."""
+    for unit in ("bytes", "KiB", "MiB", "GiB", "TiB"):
+        if num_bytes < 1024 or unit == "TiB":
+            return f"{num_bytes} {unit}" if unit == "bytes" else f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+
+
+def write_orphaned_files(project, workspace, manifest, submission_ids=None, include=None, exclude=None,
+                         page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, list_workers=DEFAULT_LIST_WORKERS):
+    """Write the path and size of every unreferenced file in the submission directories of the workspace bucket to manifest.
+
+    Only files under <submission id>/ or submissions/<submission id>/ of the given submissions (default all) are
+    considered. The bucket listing is streamed and checked against the referenced paths in batches, so memory use
+    doesn't grow with the number of files in the bucket.
+
+    Returns (number of orphaned files, total bytes).
+    """
+    workspace_json = call_fiss(fapi.get_workspace, 200, project, workspace,
+                               fields="workspace.bucketName,workspace.attributes")["workspace"]
+    bucket_name = workspace_json["bucketName"]
+
+    all_submission_ids = {submission["submissionId"] for submission in call_fiss(fapi.list_submissions, 200, project, workspace)}
+    if submission_ids:
+        unknown_ids = set(submission_ids) - all_submission_ids
+        if unknown_ids:
+            print(f"Not submission(s) in {project}/{workspace}: {', '.join(sorted(unknown_ids))}")
+            exit(1)
+    else:
+        submission_ids = sorted(all_submission_ids)
+
+    referenced = get_referenced_files(project, workspace, workspace_json, page_size, concurrency)
+    print(f"Found {len(referenced)} referenced files in {project}/{workspace}.")
+
+    orphaned_files = 0
+    orphaned_bytes = 0
+    listed_files = 0
+
+    def check(files):
+        nonlocal orphaned_files, orphaned_bytes
+        keys = np.array([hash64(path) for path, size in files], dtype=np.uint64)
+        positions = np.searchsorted(referenced, keys)
+        positions[positions == len(referenced)] = 0
+        is_referenced = referenced[positions] == keys if len(referenced) else np.zeros(len(keys), dtype=bool)
+        for (path, size), path_is_referenced in zip(files, is_referenced):
+            if not path_is_referenced and can_delete(path, include, exclude):
+                manifestout.write(f"{path}\t{size}\n")
+                orphaned_files += 1
+                orphaned_bytes += size
+
+    prefixes = [prefix for submission_id in submission_ids for prefix in (f"{submission_id}/", f"submissions/{submission_id}/")]
+    print(f"Listing the directories of {len(submission_ids)} submission(s) in gs://{bucket_name}.")
+    with open(manifest, "w") as manifestout:
+        files = []
+        for bucket_file in tqdm(iter_bucket_files(bucket_name, prefixes, list_workers), unit=" files"):
+            files.append(bucket_file)
+            if len(files) == LOOKUP_BATCH_SIZE:
+                check(files)
+                listed_files += len(files)
+                files = []
+        if files:
+            check(files)
+            listed_files += len(files)
+
+    print(f"Found {orphaned_files} unreferenced files totaling {format_size(orphaned_bytes)} out of {listed_files} files "
+          f"in the submission directories, written to {manifest}.")
+    return orphaned_files, orphaned_bytes
+
+
+def read_manifest_totals(manifest):
+    """Return (number of files, total bytes) listed in a manifest."""
+    num_files = 0
+    num_bytes = 0
+    with open(manifest, "r") as manifestin:
+        for line in manifestin:
+            num_files += 1
+            num_bytes += int(line.rstrip("\r\n").split("\t")[1])
+    return num_files, num_bytes
+
+
+def confirm_delete(manifest, yes=False):
+    """Return True if the files in a manifest may be deleted: with yes, or once the user confirms at the prompt."""
+    if yes:
+        return True
+    num_files, num_bytes = read_manifest_totals(manifest)
+    if not sys.stdin.isatty():
+        print(f"Not deleting the {num_files} files in {manifest} without confirmation, add --yes to delete them.")
+        return False
+    answer = input(f"WARNING: delete the {num_files} files totaling {format_size(num_bytes)} listed in {manifest}? "
+                   f"They cannot be recovered. [y/N] ")
+    return answer.strip().lower() in ("y", "yes")
+
+
+def delete_batch(bucket, names):
+    """Delete a batch of objects in one batch request and return how many could not be deleted.
+
+    If the batch fails, its objects are deleted one at a time; objects that are already gone count as deleted.
+    """
+    try:
+        with get_storage_client().batch():
+            for name in names:
+                bucket.delete_blob(name)
+        return 0
+    except gexceptions.GoogleAPICallError:
+        pass
+
+    failed = 0
+    for name in names:
+        try:
+            bucket.delete_blob(name)
+        except gexceptions.NotFound:
+            pass
+        except gexceptions.GoogleAPICallError as e:
+            print(f"Could not delete gs://{bucket.name}/{name}: {e}")
+            failed += 1
+    return failed
+
+
+def delete_files_in_manifest(manifest, workers=DEFAULT_DELETE_WORKERS):
+    """Delete every file listed in a manifest, in batches sent by `workers` threads, and return how many failed."""
+    deleted_files = 0
+    failed_files = 0
+    with open(manifest, "r") as manifestin, ThreadPoolExecutor(max_workers=workers) as executor, tqdm(unit=" files") as progress:
+        def collect(num_files, failed):
+            nonlocal deleted_files, failed_files
+            deleted_files += num_files - failed
+            failed_files += failed
+            progress.update(num_files)
+
+        # waits for a worker to finish before reading more of the manifest so memory use stays bounded
+        deletes = BoundedSubmitter(executor, 2 * workers, collect)
+
+        def submit(bucket_name, names):
+            deletes.submit(len(names), delete_batch, get_storage_client().bucket(bucket_name), names)
+
+        batch_bucket, names = None, []
+        for line in manifestin:
+            bucket_name, _, name = line.split("\t")[0][len("gs://"):].partition("/")
+            if names and (bucket_name != batch_bucket or len(names) == DELETE_BATCH_SIZE):
+                submit(batch_bucket, names)
+                names = []
+            batch_bucket = bucket_name
+            names.append(name)
+        if names:
+            submit(batch_bucket, names)
+        deletes.wait_all()
+
+    metrics.record_rows("deleted", deleted_files)
+    print(f"Deleted {deleted_files} files" + (f", {failed_files} could not be deleted." if failed_files else "."))
+    return failed_files
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Finds and deletes workflow intermediate files in a Terra workspace bucket that the workspace doesn't reference.")
+    # application arguments
+    parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
+    parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
+    parser.add_argument('-m', '--manifest', type=str, help='Path to write the unreferenced files to (default <project>_<workspace>_orphaned_files.tsv).')
+    parser.add_argument('-d', '--delete', action='store_true', help='Delete the unreferenced files once the manifest is written, after confirmation (default: only write the manifest).')
+    parser.add_argument('--delete_manifest', type=str, help='Delete the files listed in a manifest written by a previous run, after confirmation, instead of searching the bucket again.')
+    parser.add_argument('-y', '--yes', action='store_true', help='Delete without asking for confirmation.')
+    parser.add_argument('-s', '--submission_id', type=str, nargs='+', help='Only search the directories of these submissions (default: all submissions).')
+    parser.add_argument('-i', '--include', type=str, nargs='+', help='Only delete files whose names match one of these globs, e.g. -i "*.bam" "*.bai"')
+    parser.add_argument('-x', '--exclude', type=str, nargs='+', help='Never delete files whose names match one of these globs.')
+    parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to read per page when collecting references.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of pages to request in parallel when collecting references.')
+    parser.add_argument('--list_workers', type=int, default=DEFAULT_LIST_WORKERS, help='Number of submission directories to list in parallel.')
+    parser.add_argument('--delete_workers', type=int, default=DEFAULT_DELETE_WORKERS, help='Number of delete batches to send in parallel.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    configure_client(args.concurrency, args.requests_per_second)
+    with reporting(args):
+        if args.delete_manifest:
+            if confirm_delete(args.delete_manifest, args.yes):
+                delete_files_in_manifest(args.delete_manifest, args.delete_workers)
+        else:
+            manifest = args.manifest or f"{args.project}_{args.workspace}_orphaned_files.tsv"
+            orphaned_files, _ = write_orphaned_files(args.project, args.workspace, manifest, args.submission_id, args.include,
+                                                     args.exclude, args.page_size, args.concurrency, args.list_workers)
+            if orphaned_files and args.delete and confirm_delete(manifest, args.yes):
+                delete_files_in_manifest(manifest, args.delete_workers)
+            elif orphaned_files and not args.delete:
+                print(f"Nothing was deleted. Check {manifest}, then delete the files it lists with --delete_manifest {manifest}.")
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Rewrite references (e.g. bucket paths or DRS urls) in the data tables and attributes of a Terra workspace."""
+import argparse
+import math
+import os
+import re
+from common import DEFAULT_REQUESTS_PER_SECOND, call_fiss, configure_client, write_file_to_bucket
+from concurrent.futures import ThreadPoolExecutor
+from export_large_tsv.export_large_tsv import DEFAULT_CONCURRENCY, DEFAULT_PAGE_SIZE, format_tsv_value, get_entity_types, iter_entity_pages
+from firecloud import api as fapi
+from import_large_tsv.import_large_tsv import DEFAULT_CHUNK_BYTES, DEFAULT_MAX_CHUNK_ROWS, DEFAULT_WORKERS, ChunkSizer, GroupedChunkUploader
+from metrics import add_metrics_arguments, metrics, reporting
+from tqdm import tqdm
+
+
+class RewriteRules:
+    """An ordered list of literal and regex substitutions compiled into a single pattern.
+
+    Every value is scanned once: at each position the first rule (in the order given) that matches is applied and
+    scanning continues after the match, so the output of one rule is never rewritten by another. Regex rules may use
+    groups in their replacement (e.g. \\1), but not backreferences inside the pattern itself.
+    """
+
+    def __init__(self, rules):
+        # rules is a list of (kind, pattern, replacement) with kind "literal" or "regex"
+        self.rules = []
+        alternatives = []
+        for number, (kind, pattern, replacement) in enumerate(rules):
+            if kind == "literal":
+                self.rules.append((None, replacement))
+                alternatives.append(f"(?P<rule{number}>{re.escape(pattern)})")
+            elif kind == "regex":
+                self.rules.append((re.compile(pattern), replacement))
+                alternatives.append(f"(?P<rule{number}>{pattern})")
+            else:
+                raise ValueError(f"Unknown rule type {kind}, expected literal or regex.")
+        self.pattern = re.compile("|".join(alternatives))
+
+    def _replace(self, match):
+        for number, (regex, replacement) in enumerate(self.rules):
+            matched = match.group(f"rule{number}")
+            if matched is not None:
+                if regex is None:
+                    return replacement
+                # match at the same position of the whole value, so lookarounds see the text around the match
+                return regex.match(match.string, match.start()).expand(replacement)
+
+    def rewrite(self, value):
+        """Return the value with every rule applied in a single pass."""
+        return self.pattern.sub(self._replace, value)
+
+    def rewrite_attribute(self, value):
+        """Return an attribute value from the API with its strings rewritten, including those in lists and nested
+        json objects, leaving entity references and reference lists untouched."""
+        if isinstance(value, str):
+            return self.rewrite(value)
+        if isinstance(value, list):
+            return [self.rewrite_attribute(item) for item in value]
+        if isinstance(value, dict):
+            if "entityName" in value or value.get("itemsType") == "EntityReference":
+                return value
+            if value.get("itemsType") == "AttributeValue":
+                return dict(value, items=self.rewrite_attribute(value["items"]))
+            return {key: self.rewrite_attribute(item) for key, item in value.items()}
+        return value
+
+
+def read_rules(rules_tsv):
+    """Read (kind, pattern, replacement) rules from a tsv with "literal" or "regex", the pattern and its replacement on each line."""
+    rules = []
+    with open(rules_tsv, "r") as rules_file:
+        for line in rules_file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            kind, pattern, replacement = line.rstrip("\r\n").split("\t")
+            rules.append((kind, pattern, replacement))
+    return rules
+
+
+def rewrite_workspace_attributes(project, workspace, rules, changes, dry_run=False):
+    """Rewrite the workspace attributes, recording each change in the open changes tsv, and return how many changed."""
+    response = call_fiss(fapi.get_workspace, 200, project, workspace, fields="workspace.attributes")
+    updates = []
+    for name, value in response["workspace"]["attributes"].items():
+        new_value = rules.rewrite_attribute(value)
+        if new_value != value:
+            changes.write("\t".join(["workspace", workspace, name, format_tsv_value(value), format_tsv_value(new_value)]) + "\n")
+            updates.append(fapi._attr_set(name, new_value))
+
+    if updates and not dry_run:
+        call_fiss(fapi.update_workspace_attributes, 200, project, workspace, updates)
+    print(f"{len(updates)} workspace attribute(s) {'to rewrite' if dry_run else 'rewritten'}.")
+    return len(updates)
+
+
+def rewrite_entity_table(project, workspace, entity_type, entity_types_json, rules, changes, dry_run=False,
+                         page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, workers=DEFAULT_WORKERS,
+                         chunk_bytes=DEFAULT_CHUNK_BYTES, max_rows=DEFAULT_MAX_CHUNK_ROWS):
+    """Stream a data table from the workspace, rewrite its values and upload only the rows that changed.
+
+    Changed rows are grouped by the set of columns that changed, so each upload only sets the attributes that were
+    rewritten. Groups are buffered and uploaded by a GroupedChunkUploader with `workers` concurrent requests, so
+    memory use is bounded by the upload chunk size and in-flight uploads rather than the size of the table.
+
+    Returns (rows changed, rows failed to upload).
+    """
+    entity_count = entity_types_json[entity_type]["count"]
+    id_name = entity_types_json[entity_type]["idName"]
+    num_pages = int(math.ceil(float(entity_count) / page_size))
+    sizer = ChunkSizer(chunk_bytes)
+
+    changed_rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploader = GroupedChunkUploader(project, workspace, executor, sizer, max_rows, workers)
+        print(f"Rewriting {entity_count} {entity_type}(s).")
+        page_responses = iter_entity_pages(project, workspace, entity_type, range(1, num_pages + 1), page_size, concurrency)
+        for page, page_response in tqdm(page_responses, total=num_pages):
+            for entity_json in page_response["results"]:
+                name = entity_json["name"]
+                new_values = {}
+                for column, value in entity_json["attributes"].items():
+                    new_value = rules.rewrite_attribute(value)
+                    if new_value != value:
+                        changes.write("\t".join([entity_type, name, column, format_tsv_value(value), format_tsv_value(new_value)]) + "\n")
+                        new_values[column] = format_tsv_value(new_value)
+                if not new_values:
+                    continue
+
+                changed_rows += 1
+                if dry_run:
+                    continue
+                columns = sorted(new_values)
+                header = "\t".join([f"entity:{id_name}"] + columns).encode("utf-8") + b"\n"
+                uploader.add_row(header, "\t".join([name] + [new_values[column] for column in columns]).encode("utf-8") + b"\n")
+
+        _, failed_rows = uploader.flush()
+
+    metrics.record_rows("rewritten", changed_rows)
+    print(f"{changed_rows} {entity_type}(s) {'to rewrite' if dry_run else 'rewritten'}"
+          + (f", {failed_rows} failed to upload." if failed_rows else "."))
+    return changed_rows, failed_rows
+
+
+def rewrite_data_model_references(project, workspace, rules, changes_tsv, entity_types=None, workspace_attributes=True,
+                                  dry_run=False, provenance_bucket=None, page_size=DEFAULT_PAGE_SIZE,
+                                  concurrency=DEFAULT_CONCURRENCY, workers=DEFAULT_WORKERS):
+    """Rewrite the given data tables (default all) and the workspace attributes of a workspace.
+
+    Every changed value is written to changes_tsv with its entity type, entity name, attribute, old and new value.
+    With dry_run nothing is uploaded, so changes_tsv shows what would be rewritten. If provenance_bucket is given,
+    changes_tsv is copied to it once the rewrite is finished.
+    """
+    entity_types_json = get_entity_types(project, workspace)
+    if entity_types is None:
+        entity_types = list(entity_types_json)
+
+    summary = {}
+    with open(changes_tsv, "w") as changes:
+        changes.write("\t".join(["entity_type", "entity_name", "attribute", "old_value", "new_value"]) + "\n")
+        if workspace_attributes:
+            summary["workspace attributes"] = (rewrite_workspace_attributes(project, workspace, rules, changes, dry_run), 0)
+        for entity_type in entity_types:
+            if entity_type not in entity_types_json:
+                print(f"There is no {entity_type} table in {project}/{workspace}, skipping it.")
+                continue
+            summary[entity_type] = rewrite_entity_table(project, workspace, entity_type, entity_types_json, rules, changes,
+                                                        dry_run, page_size, concurrency, workers)
+
+    print(f"Rewrite summary{' (dry run, nothing was uploaded)' if dry_run else ''}:")
+    for name, (changed, failed) in summary.items():
+        print(f"\t{name}: {changed} changed" + (f", {failed} failed to upload" if failed else ""))
+    print(f"Every changed value is listed in {changes_tsv}.")
+
+    if provenance_bucket is not None:
+        write_file_to_bucket(changes_tsv, os.path.basename(changes_tsv), provenance_bucket)
+
+    return summary
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Rewrites references such as bucket paths in the data tables and workspace attributes of a Terra workspace.")
+    # application arguments
+    parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
+    parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
+    parser.add_argument('-r', '--rules', type=str, help='Path to a tsv of rules: literal or regex, pattern, replacement on each line.')
+    parser.add_argument('--replace', nargs=2, action='append', metavar=('OLD', 'NEW'), default=[], help='Replace the literal OLD with NEW, e.g. --replace gs://old-bucket/ gs://new-bucket/. Can be given multiple times and is applied before the rules file.')
+    parser.add_argument('-e', '--entity_types', nargs='+', help='Data tables to rewrite (default: all).')
+    parser.add_argument('--skip_workspace_attributes', action='store_true', help='Do not rewrite the workspace attributes.')
+    parser.add_argument('-o', '--changes_tsv', type=str, help='Path to write every changed value to (default <project>_<workspace>_rewrites.tsv).')
+    parser.add_argument('-d', '--dry_run', action='store_true', help='Only write the changes tsv, without uploading anything.')
+    parser.add_argument('-b', '--provenance_bucket', type=str, help='Bucket to copy the changes tsv to when finished.')
+    parser.add_argument('-n', '--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Number of entities/rows to export per page.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of pages to request in parallel.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of chunks of changed rows to upload in parallel.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    rules = [("literal", old, new) for old, new in args.replace]
+    if args.rules:
+        rules += read_rules(args.rules)
+    if not rules:
+        parser.error("at least one --replace or a --rules file is required")
+    changes_tsv = args.changes_tsv or f"{args.project}_{args.workspace}_rewrites.tsv"
+
+    configure_client(max(args.concurrency, args.workers), args.requests_per_second)
+    with reporting(args):
+        rewrite_data_model_references(args.project, args.workspace, RewriteRules(rules), changes_tsv, args.entity_types,
+                                      not args.skip_workspace_attributes, args.dry_run, args.provenance_bucket,
+                                      args.page_size, args.concurrency, args.workers)
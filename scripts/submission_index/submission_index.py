@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Keep a local SQLite index of the submissions and workflows in a Terra workspace to find the workflows run on an entity."""
+import argparse
+import sqlite3
+from common import DEFAULT_REQUESTS_PER_SECOND, call_fiss, configure_client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from firecloud import api as fapi
+from metrics import add_metrics_arguments, metrics, reporting
+from tqdm import tqdm
+
+DEFAULT_CONCURRENCY = 8
+# submissions in these states never change again, so they are only fetched once
+TERMINAL_SUBMISSION_STATUSES = ("Done", "Aborted")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workspace (
+    project TEXT NOT NULL,
+    workspace TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id TEXT PRIMARY KEY,
+    status TEXT,
+    submission_date TEXT,
+    submitter TEXT,
+    method_namespace TEXT,
+    method_name TEXT,
+    entity_type TEXT,
+    entity_name TEXT,
+    user_comment TEXT
+);
+CREATE TABLE IF NOT EXISTS workflows (
+    submission_id TEXT NOT NULL REFERENCES submissions (submission_id),
+    workflow_id TEXT,
+    entity_type TEXT,
+    entity_name TEXT,
+    status TEXT,
+    cost REAL,
+    status_last_changed TEXT
+);
+CREATE INDEX IF NOT EXISTS workflows_entity ON workflows (entity_name, entity_type);
+CREATE INDEX IF NOT EXISTS workflows_submission ON workflows (submission_id);
+CREATE INDEX IF NOT EXISTS workflows_workflow ON workflows (workflow_id);
+"""
+
+
+class SubmissionIndex:
+    """SQLite index of the submissions in a workspace and the entity, method and status of each of their workflows."""
+
+    def __init__(self, db_path, project, workspace):
+        self.project = project
+        self.workspace = workspace
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            indexed = self.connection.execute("SELECT project, workspace FROM workspace").fetchone()
+            if indexed is None:
+                self.connection.execute("INSERT INTO workspace VALUES (?, ?)", (project, workspace))
+            elif tuple(indexed) != (project, workspace):
+                raise ValueError(f"{db_path} is an index of {indexed['project']}/{indexed['workspace']}, not {project}/{workspace}")
+
+    def close(self):
+        self.connection.close()
+
+    def get_submissions_to_fetch(self, submissions):
+        """Return the ids of the listed submissions that are new, or weren't finished when they were last fetched."""
+        indexed_statuses = dict(self.connection.execute("SELECT submission_id, status FROM submissions"))
+        return [submission["submissionId"] for submission in submissions
+                if indexed_statuses.get(submission["submissionId"]) not in TERMINAL_SUBMISSION_STATUSES]
+
+    def save_submission(self, submission):
+        """Replace the indexed submission and its workflows with a get_submission response."""
+        submission_id = submission["submissionId"]
+        submission_entity = submission.get("submissionEntity", {})
+        workflows = []
+        for workflow in submission.get("workflows", []):
+            workflow_entity = workflow.get("workflowEntity", {})
+            workflows.append((submission_id, workflow.get("workflowId"), workflow_entity.get("entityType"),
+                              workflow_entity.get("entityName"), workflow.get("status"), workflow.get("cost"),
+                              workflow.get("statusLastChangedDate")))
+
+        with self.connection:
+            self.connection.execute("DELETE FROM workflows WHERE submission_id = ?", (submission_id,))
+            self.connection.executemany("INSERT INTO workflows VALUES (?, ?, ?, ?, ?, ?, ?)", workflows)
+            self.connection.execute("INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (submission_id, submission.get("status"), submission.get("submissionDate"),
+                                     submission.get("submitter"), submission.get("methodConfigurationNamespace"),
+                                     submission.get("methodConfigurationName"), submission_entity.get("entityType"),
+                                     submission_entity.get("entityName"), submission.get("userComment")))
+
+    def refresh(self, concurrency=DEFAULT_CONCURRENCY):
+        """Fetch the submissions that are new or not yet finished, concurrently, and return how many were fetched."""
+        submissions = call_fiss(fapi.list_submissions, 200, self.project, self.workspace)
+        to_fetch = self.get_submissions_to_fetch(submissions)
+        print(f"{len(submissions)} submissions in {self.project}/{self.workspace}, fetching {len(to_fetch)} new or unfinished submissions.")
+
+        # fetch in parallel, but write to sqlite from this thread only
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(call_fiss, fapi.get_submission, 200, self.project, self.workspace, submission_id)
+                       for submission_id in to_fetch]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                self.save_submission(future.result())
+
+        metrics.record_rows("indexed_submissions", len(to_fetch))
+        return len(to_fetch)
+
+    def find_workflows(self, entity_name, entity_type=None):
+        """Return the workflows run on an entity, newest submission first, as dicts."""
+        query = """
+            SELECT submissions.method_namespace || '/' || submissions.method_name AS method_info,
+                   workflows.submission_id, workflows.workflow_id, workflows.entity_type, workflows.status,
+                   submissions.submission_date
+            FROM workflows JOIN submissions USING (submission_id)
+            WHERE workflows.entity_name = ?"""
+        params = [entity_name]
+        if entity_type is not None:
+            query += " AND workflows.entity_type = ?"
+            params.append(entity_type)
+        query += " ORDER BY submissions.submission_date DESC"
+        return [dict(row) for row in self.connection.execute(query, params)]
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Index the submissions in a Terra workspace and find the workflows run on an entity.")
+    # application arguments
+    parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
+    parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
+    parser.add_argument('-d', '--database', type=str, help='Path to the SQLite index (default: <project>_<workspace>_submissions.db).')
+    parser.add_argument('-e', '--entity_name', type=str, help='Entity to find workflows for, e.g. a sample_id.')
+    parser.add_argument('-t', '--entity_type', type=str, help='Only find workflows run on entities of this type.')
+    parser.add_argument('-n', '--no_refresh', action='store_true', help='Query the index without fetching new submissions first.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of submissions to fetch in parallel.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    configure_client(args.concurrency, args.requests_per_second)
+    with reporting(args):
+        index = SubmissionIndex(args.database or f"{args.project}_{args.workspace}_submissions.db", args.project, args.workspace)
+        if not args.no_refresh:
+            index.refresh(args.concurrency)
+        if args.entity_name:
+            workflows = index.find_workflows(args.entity_name, args.entity_type)
+            print(f"{len(workflows)} workflows found for {args.entity_name}:")
+            for workflow_info in workflows:
+                print(workflow_info)
+        index.close()
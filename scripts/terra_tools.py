@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Single entry point for the terra-tools scripts: terra-tools <command> [arguments].
+
+Each command runs its script as if it was run directly, so only the modules that script needs are imported, and
+`terra-tools <command> -h` shows the script's own arguments.
+"""
+import os
+import runpy
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+# {command: (script path relative to the scripts directory, description)}
+COMMANDS = {
+    "export": ("export_large_tsv/export_large_tsv.py", "Export a data table to a tsv, tsv.gz, ndjson or parquet file."),
+    "import": ("import_large_tsv/import_large_tsv.py", "Upload a large tsv to a data table."),
+    "bulk-import": ("import_large_tsv/bulk_import_large_tsvs.py", "Upload several large tsvs to data tables, in dependency order."),
+    "delta-import": ("import_large_tsv/delta_import_large_tsv.py", "Upload only the new or changed rows of a tsv."),
+    "copy": ("import_large_tsv/copy_data_tables.py", "Copy the data tables of one workspace to another."),
+    "rewrite": ("rewrite_data_model/rewrite_data_model_references.py", "Rewrite references such as bucket paths in the data tables."),
+    "remove-intermediates": ("remove_workflow_intermediates/remove_workflow_intermediates.py", "Delete unreferenced workflow intermediates from the workspace bucket."),
+    "workflow-metadata": ("workflow_metadata/harvest_workflow_metadata.py", "Harvest workflow status, cost and duration into a parquet or arrow file."),
+    "submission-index": ("submission_index/submission_index.py", "Find the workflows run on an entity from a local index of submissions."),
+    "token": ("get_access_token.py", "Print an access token, cached on disk until shortly before it expires."),
+    "register": ("register_service_account/register_service_account.py", "Register a service account for use in Terra."),
+}
+
+
+def print_usage():
+    print("usage: terra-tools <command> [arguments]\n\ncommands:")
+    for command, (_, description) in COMMANDS.items():
+        print(f"  {command:<22}{description}")
+    print("\nRun terra-tools <command> -h for the arguments of a command.")
+
+
+def run_command(command, arguments):
+    """Run the script of a command with the given arguments, as if it was run directly."""
+    script_path = os.path.join(SCRIPTS_DIR, COMMANDS[command][0])
+    # the scripts import their shared modules from the scripts directory and their siblings from their own directory
+    for path in (SCRIPTS_DIR, os.path.dirname(script_path)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    sys.argv = [script_path] + arguments
+    runpy.run_path(script_path, run_name="__main__")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print_usage()
+        exit(0 if len(sys.argv) >= 2 else 1)
+    if sys.argv[1] not in COMMANDS:
+        print(f"terra-tools: unknown command {sys.argv[1]}\n")
+        print_usage()
+        exit(1)
+
+    run_command(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Harvest the status, cost and duration of every workflow in a Terra workspace into a Parquet or Arrow file."""
+import argparse
+import gzip
+import json
+import os
+from common import DEFAULT_REQUESTS_PER_SECOND, BoundedSubmitter, call_fiss, configure_client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from firecloud import api as fapi
+from metrics import add_metrics_arguments, reporting
+from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "terra-tools", "workflow_metadata")
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+BATCH_ROWS = 10000
+# metadata of workflows in these states never changes, so it is cached
+TERMINAL_WORKFLOW_STATUSES = ("Succeeded", "Failed", "Aborted")
+# unless the full metadata is requested, only these keys are fetched, which keeps responses small
+SUMMARY_METADATA_KEYS = ["id", "status", "start", "end", "workflowName"]
+
+SCHEMA = pa.schema([
+    ("submission_id", pa.string()),
+    ("workflow_id", pa.string()),
+    ("entity_type", pa.string()),
+    ("entity_name", pa.string()),
+    ("status", pa.string()),
+    ("cost", pa.float64()),
+    ("start", pa.timestamp("ms", tz="UTC")),
+    ("end", pa.timestamp("ms", tz="UTC")),
+    ("duration_seconds", pa.float64()),
+    ("workflow_name", pa.string()),
+    ("submitter", pa.string()),
+    ("submission_date", pa.string()),
+])
+
+
+class MetadataCache:
+    """Directory of gzipped workflow metadata json, limited to max_bytes by evicting the least recently used files."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, workflow_id):
+        return os.path.join(self.cache_dir, f"{workflow_id}.json.gz")
+
+    def get(self, workflow_id):
+        """Return the cached metadata of a workflow, or None."""
+        path = self.path(workflow_id)
+        try:
+            with gzip.open(path, "rt") as cached:
+                metadata = json.load(cached)
+        except (OSError, ValueError):
+            return None
+        # mark the file as recently used so it is evicted last
+        os.utime(path)
+        return metadata
+
+    def put(self, workflow_id, metadata):
+        path = self.path(workflow_id)
+        with gzip.open(path + ".tmp", "wt") as cached:
+            json.dump(metadata, cached)
+        os.replace(path + ".tmp", path)
+
+    def evict(self):
+        """Delete the least recently used files until the cache fits in max_bytes, and return how many were deleted."""
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json.gz")]
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        evicted = 0
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+            evicted += 1
+        return evicted
+
+
+def parse_time(value):
+    """Parse a Cromwell timestamp, e.g. 2021-06-01T12:00:00.000Z, returning None if there isn't one."""
+    if not value:
+        return None
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, time_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+
+def get_workflow_row(submission, workflow, metadata):
+    """Return the output row for a workflow of a submission, with its metadata if it has any."""
+    metadata = metadata or {}
+    workflow_entity = workflow.get("workflowEntity", {})
+    start = parse_time(metadata.get("start"))
+    end = parse_time(metadata.get("end"))
+    return {
+        "submission_id": submission["submissionId"],
+        "workflow_id": workflow.get("workflowId"),
+        "entity_type": workflow_entity.get("entityType"),
+        "entity_name": workflow_entity.get("entityName"),
+        "status": workflow.get("status"),
+        "cost": workflow.get("cost"),
+        "start": start,
+        "end": end,
+        "duration_seconds": (end - start).total_seconds() if start and end else None,
+        "workflow_name": metadata.get("workflowName"),
+        "submitter": submission.get("submitter"),
+        "submission_date": submission.get("submissionDate"),
+    }
+
+
+def open_writer(output_path, output_format):
+    """Open a Parquet or Arrow IPC file writer for the output table."""
+    if output_format == "parquet":
+        return pq.ParquetWriter(output_path, SCHEMA)
+    return pa.ipc.new_file(output_path, SCHEMA)
+
+
+def write_rows(writer, rows):
+    """Write a batch of output rows to the writer as one record batch/row group."""
+    columns = {name: [row[name] for row in rows] for name in SCHEMA.names}
+    writer.write_table(pa.Table.from_pydict(columns, schema=SCHEMA))
+
+
+def harvest_workflow_metadata(project, workspace, output_path, submission_ids=None, output_format="parquet",
+                              cache_dir=DEFAULT_CACHE_DIR, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                              concurrency=DEFAULT_CONCURRENCY, full_metadata=False):
+    """Write a row per workflow in the given submissions (default all) of a workspace to a columnar file.
+
+    Submissions and workflow metadata are fetched `concurrency` at a time. Metadata of finished workflows is cached in
+    cache_dir, so later runs only fetch workflows that are new or were still running. Rows are written in batches.
+    """
+    include_key = None if full_metadata else SUMMARY_METADATA_KEYS
+    cache = MetadataCache(os.path.join(cache_dir, "full" if full_metadata else "summary"), cache_max_bytes)
+
+    submissions = call_fiss(fapi.list_submissions, 200, project, workspace)
+    if submission_ids:
+        submissions = [submission for submission in submissions if submission["submissionId"] in submission_ids]
+
+    num_rows = 0
+    batch = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open_writer(output_path, output_format) as writer:
+        def add_row(submission, workflow, metadata):
+            nonlocal num_rows, batch
+            batch.append(get_workflow_row(submission, workflow, metadata))
+            num_rows += 1
+            if len(batch) == BATCH_ROWS:
+                write_rows(writer, batch)
+                batch = []
+
+        print(f"Getting the workflows of {len(submissions)} submission(s) in {project}/{workspace}.")
+        futures = [executor.submit(call_fiss, fapi.get_submission, 200, project, workspace, submission["submissionId"])
+                   for submission in submissions]
+        to_fetch = []
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            submission = future.result()
+            for workflow in submission.get("workflows", []):
+                if "workflowId" not in workflow:
+                    # the workflow never started, so there is no metadata to fetch
+                    add_row(submission, workflow, None)
+                    continue
+                metadata = cache.get(workflow["workflowId"])
+                if metadata is None:
+                    to_fetch.append((submission, workflow))
+                else:
+                    add_row(submission, workflow, metadata)
+
+        print(f"Getting the metadata of {len(to_fetch)} workflow(s), {num_rows} were cached or never started.")
+        def finish(submission_workflow, metadata):
+            submission, workflow = submission_workflow
+            if metadata.get("status", workflow.get("status")) in TERMINAL_WORKFLOW_STATUSES:
+                cache.put(workflow["workflowId"], metadata)
+            add_row(submission, workflow, metadata)
+            progress.update()
+
+        with tqdm(total=len(to_fetch)) as progress:
+            # keep a bounded number of metadata responses in memory
+            fetches = BoundedSubmitter(executor, 2 * concurrency, finish)
+            for submission, workflow in to_fetch:
+                fetches.submit((submission, workflow), call_fiss, fapi.get_workflow_metadata, 200, project, workspace,
+                               submission["submissionId"], workflow["workflowId"], include_key=include_key)
+            fetches.wait_all()
+
+        if batch:
+            write_rows(writer, batch)
+
+    evicted = cache.evict()
+    print(f"Wrote {num_rows} workflow(s) to {output_path}." + (f" Evicted {evicted} workflow(s) from the cache." if evicted else ""))
+    return num_rows
+
+
+if __name__ == "__main__":
+    # argument parser
+    parser = argparse.ArgumentParser(description="Harvest the status, cost and duration of the workflows in a Terra workspace into a Parquet or Arrow file.")
+    # application arguments
+    parser.add_argument('-p', '--project', type=str, required=True, help='Terra namespace/project of workspace.')
+    parser.add_argument('-w', '--workspace', type=str, required=True, help='Name of Terra workspace.')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Path of the Parquet or Arrow file to write.')
+    parser.add_argument('-s', '--submission_id', type=str, nargs='+', help='Submission id(s) to harvest (default: all submissions in the workspace).')
+    parser.add_argument('-f', '--format', type=str, choices=['parquet', 'arrow'], default='parquet', help='Output file format.')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Directory to cache the metadata of finished workflows in.')
+    parser.add_argument('--cache_max_bytes', type=int, default=DEFAULT_CACHE_MAX_BYTES, help='Maximum size of the cache, least recently used workflows are evicted beyond it.')
+    parser.add_argument('--full_metadata', action='store_true', help='Fetch and cache the complete workflow metadata instead of only the keys written to the output.')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of API requests to send in parallel.')
+    parser.add_argument('--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of API requests to send per second.')
+
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    configure_client(args.concurrency, args.requests_per_second)
+    with reporting(args):
+        harvest_workflow_metadata(args.project, args.workspace, args.output, args.submission_id, args.format,
+                                  args.cache_dir, args.cache_max_bytes, args.concurrency, args.full_metadata)
@@ -0,0 +1,31 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# the scripts import their shared modules from the scripts directory and their siblings from their own directory
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+IMPORT_LARGE_TSV_DIR = os.path.join(SCRIPTS_DIR, "import_large_tsv")
+sys.path.insert(0, SCRIPTS_DIR)
+
+
+@pytest.fixture
+def import_script():
+    """Return a function importing a script of scripts/import_large_tsv the way it is run, with its siblings importable by name.
+
+    The script directory shadows the import_large_tsv package other scripts import from, so it is only on the path
+    during the test, and the script modules imported during the test are dropped afterwards.
+    """
+    saved_path = list(sys.path)
+    saved_modules = dict(sys.modules)
+    sys.path.insert(0, IMPORT_LARGE_TSV_DIR)
+    sys.modules.pop("import_large_tsv", None)
+    try:
+        yield importlib.import_module
+    finally:
+        sys.path[:] = saved_path
+        for name, module in list(sys.modules.items()):
+            if name not in saved_modules and getattr(module, "__file__", None) and module.__file__.startswith(SCRIPTS_DIR):
+                del sys.modules[name]
+        sys.modules.update(saved_modules)
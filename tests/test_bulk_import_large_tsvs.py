@@ -0,0 +1,43 @@
+import json
+
+
+def write_load_file(path, header, rows):
+    path.write_text("\n".join(["\t".join(header)] + ["\t".join(row) for row in rows]) + "\n")
+    return str(path)
+
+
+def test_json_references_make_a_table_depend_on_the_referenced_table(tmp_path, import_script):
+    bulk = import_script("bulk_import_large_tsvs")
+    reference = json.dumps({"entityType": "sample", "entityName": "sample_1"})
+    participant = write_load_file(tmp_path / "participant.tsv", ["entity:participant_id", "age"], [["participant_1", "30"]])
+    sample = write_load_file(tmp_path / "sample.tsv", ["entity:sample_id", "participant"], [["sample_1", "participant_1"]])
+    pair = write_load_file(tmp_path / "pair.tsv", ["entity:pair_id", "case_sample", "control_sample"],
+                           [["pair_1", reference, reference]])
+    sample_set = write_load_file(tmp_path / "sample_set.tsv", ["entity:sample_set_id"], [["set_1"]])
+    membership = write_load_file(tmp_path / "sample_set_membership.tsv", ["membership:sample_set_id", "sample"], [["set_1", "sample_1"]])
+
+    tables = {data_table: bulk.read_table_header(data_table) for data_table in (participant, sample, pair, sample_set, membership)}
+    referenced_types = {data_table: bulk.read_referenced_types(data_table) for data_table in tables}
+    assert referenced_types[pair] == {"sample"}
+
+    dependencies = bulk.get_table_dependencies(tables, referenced_types)
+    assert dependencies == {participant: set(), sample: {participant}, pair: {sample}, sample_set: {sample},
+                            membership: {sample, sample_set}}
+    # without the json references only the header is used, and the pair table doesn't wait for the samples
+    assert bulk.get_table_dependencies(tables)[pair] == set()
+
+
+def test_tables_run_in_dependency_order_and_dependents_of_failed_tables_are_skipped(import_script):
+    bulk = import_script("bulk_import_large_tsvs")
+    dependencies = {"participant": set(), "sample": {"participant"}, "pair": {"sample"}, "other": set(), "other_set": {"other"}}
+    finished = []
+
+    def run(table):
+        assert dependencies[table] <= set(finished)
+        finished.append(table)
+        return (0, 1) if table == "other" else (1, 0)
+
+    results, skipped = bulk.run_in_dependency_order(list(dependencies), dependencies, run, max_tables=2)
+    assert finished.index("participant") < finished.index("sample") < finished.index("pair")
+    assert skipped == {"other_set": "other"}
+    assert results["other_set"] is None and results["other"] == (0, 1) and results["pair"] == (1, 0)
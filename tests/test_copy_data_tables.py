@@ -0,0 +1,17 @@
+def test_tables_referenced_under_any_attribute_name_are_copied_first(import_script):
+    copy = import_script("copy_data_tables")
+    entity_types = {"pair": {"count": 1, "idName": "pair_id", "attributeNames": ["case_sample"]},
+                    "sample": {"count": 1, "idName": "sample_id", "attributeNames": ["depth"]}}
+    pages = {"pair": {"results": [{"name": "pair_1", "attributes": {"case_sample": {"entityType": "sample", "entityName": "sample_1"}}}]},
+             "sample": {"results": [{"name": "sample_1", "attributes": {"depth": 30}}]}}
+    copied = []
+
+    def copy_data_table(source_project, source_workspace, project, workspace, entity_type, *args):
+        copied.append(entity_type)
+        return 1, 0
+
+    copy.get_entity_types = lambda project, workspace: entity_types
+    copy.get_entity_by_page = lambda project, workspace, entity_type, page, page_size: pages[entity_type]
+    copy.copy_data_table = copy_data_table
+    copy.copy_data_tables("source", "source_workspace", "project", "workspace", max_tables=1)
+    assert copied == ["sample", "pair"]
@@ -0,0 +1,36 @@
+import json
+
+import numpy as np
+
+SAMPLES = [
+    {"name": "sample_1", "attributes": {"participant": {"entityType": "participant", "entityName": "participant_1"}, "depth": 30}},
+    {"name": "sample_2", "attributes": {"participant": {"entityType": "participant", "entityName": "participant_2"}, "depth": 40}},
+    {"name": "sample_3", "attributes": {"participant": {"entityType": "participant", "entityName": "participant_3"}, "depth": 50}},
+]
+
+
+def reference(name):
+    return json.dumps({"entityType": "participant", "entityName": name})
+
+
+def test_references_in_the_index_match_json_references_in_the_tsv(tmp_path, monkeypatch, import_script):
+    delta = import_script("delta_import_large_tsv")
+    monkeypatch.setattr(delta, "get_entity_types", lambda project, workspace: {"sample": {"count": len(SAMPLES)}})
+    monkeypatch.setattr(delta, "iter_entity_pages", lambda *args: iter([(1, {"results": SAMPLES})]))
+    index = delta.RowIndex.build("project", "workspace", "sample", ["participant", "depth"], str(tmp_path / "names"))
+
+    ref = {"entityType": "participant", "entityName": "participant_1"}
+    assert delta.canonical_tsv_value(json.dumps(ref, indent=1)) == delta.canonical_attribute_value(ref)
+
+    tsv = tmp_path / "samples.tsv"
+    tsv.write_text("entity:sample_id\tparticipant\tdepth\n"
+                   f"sample_1\t{reference('participant_1')}\t30\n"   # unchanged
+                   f"sample_2\t{reference('participant_2')}\t41\n"   # changed depth
+                   "sample_3\tparticipant_3\t50\n"                    # a bare name would be uploaded as a string
+                   f"sample_4\t{reference('participant_4')}\t60\n")  # new
+    delta_rows, seen = delta.write_delta_tsv(str(tsv), index, str(tmp_path / "delta.tsv"))
+
+    written = (tmp_path / "delta.tsv").read_text().splitlines()
+    assert delta_rows == 3
+    assert [line.split("\t")[0] for line in written[1:]] == ["sample_2", "sample_3", "sample_4"]
+    assert np.all(seen)
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from export_large_tsv.export_large_tsv import ParquetPageWriter, format_tsv_value
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def make_page(start, values):
+    return {"results": [{"name": f"sample_{start + index}", "attributes": {"value": value}} for index, value in enumerate(values)]}
+
+
+def write_row_groups(path, *row_groups):
+    with ParquetPageWriter(str(path), ["sample_id", "value"], row_group_rows=2) as writer:
+        start = 0
+        for values in row_groups:
+            writer.write_page(make_page(start, values), "sample_id")
+            start += len(values)
+    return pq.ParquetFile(str(path))
+
+
+def test_references_are_written_as_json_the_upload_reads_as_references():
+    reference = {"entityType": "sample", "entityName": "sample_1"}
+    assert json.loads(format_tsv_value(reference)) == reference
+    assert json.loads(format_tsv_value({"itemsType": "EntityReference", "items": [reference]})) == [reference]
+    assert format_tsv_value({"itemsType": "AttributeValue", "items": [1, "a"]}) == '[1, "a"]'
+    assert json.loads(format_tsv_value({"items": [1], "kind": "json"})) == {"items": [1], "kind": "json"}
+    assert format_tsv_value(True) == "true"
+    assert format_tsv_value(None) == ""
+
+
+def test_integer_column_is_widened_to_double_by_a_later_row_group(tmp_path):
+    parquet_file = write_row_groups(tmp_path / "samples.parquet", [1, 2], [3.5, None])
+    assert parquet_file.num_row_groups == 2
+    assert str(parquet_file.schema_arrow.field("value").type) == "double"
+    assert parquet_file.read().column("value").to_pylist() == [1.0, 2.0, 3.5, None]
+
+
+def test_column_with_mixed_types_across_row_groups_is_written_as_strings(tmp_path):
+    parquet_file = write_row_groups(tmp_path / "samples.parquet", [1, 2], ["three", True], [[4], 5])
+    assert parquet_file.num_row_groups == 3
+    assert str(parquet_file.schema_arrow.field("value").type) == "string"
+    assert parquet_file.read().column("value").to_pylist() == ["1", "2", "three", "true", "[4]", "5"]
+    assert parquet_file.read().column("sample_id").to_pylist() == [f"sample_{index}" for index in range(6)]
@@ -0,0 +1,60 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from import_large_tsv import import_large_tsv
+from import_large_tsv.import_large_tsv import ChunkSizer, GroupedChunkUploader, iter_tsv_chunks
+
+HEADER = b"entity:sample_id\tvalue\n"
+ROWS = [f"sample_{index}\t{index}\n".encode("utf-8") for index in range(10)]
+
+
+def test_chunks_are_cut_at_planned_offsets():
+    tsv = HEADER + b"".join(ROWS)
+    # a chunk of the first 3 rows and one of the next 4, planned by a previous run with a different size
+    first_end = len(HEADER) + sum(len(row) for row in ROWS[:3])
+    second_end = first_end + sum(len(row) for row in ROWS[3:7])
+    planned = {(len(HEADER), first_end), (first_end, second_end)}
+
+    chunks = list(iter_tsv_chunks(io.BytesIO(tsv), ChunkSizer(1024 * 1024), max_rows=2, planned_chunks=planned))
+    assert [(start, end) for header, rows, start, end in chunks[:2]] == sorted(planned)
+    assert [len(rows) for header, rows, start, end in chunks] == [3, 4, 2, 1]
+    assert b"".join(row for chunk in chunks for row in chunk[1]) == b"".join(ROWS)
+
+
+def test_resume_against_another_workspace_uploads_every_row(tmp_path, import_script):
+    upload = import_script("import_large_tsv")
+    tsv = tmp_path / "samples.tsv"
+    tsv.write_bytes(HEADER + b"".join(ROWS))
+    uploads = []
+
+    def upload_rows(project, workspace, header, rows, sizer, upload_slots=None):
+        uploads.append((workspace, len(rows)))
+        return len(rows), 0
+
+    upload.upload_rows = upload_rows
+    assert upload.upload_tsv_to_workspace(str(tsv), "project", "workspace-one", resume=True) == (10, 0)
+    assert upload.upload_tsv_to_workspace(str(tsv), "project", "workspace-one", resume=True) == (0, 0)
+    assert upload.upload_tsv_to_workspace(str(tsv), "project", "workspace-two", resume=True) == (10, 0)
+    assert uploads == [("workspace-one", 10), ("workspace-two", 10)]
+
+
+def test_grouped_chunks_send_the_largest_partial_chunk_past_the_buffer_limit(monkeypatch):
+    uploads = []
+
+    def upload_rows(project, workspace, header, rows, sizer, upload_slots=None):
+        uploads.append((header, len(rows)))
+        return len(rows), 0
+
+    monkeypatch.setattr(import_large_tsv, "upload_rows", upload_rows)
+    other_header = b"entity:sample_id\tother\n"
+    sparse_header = b"entity:sample_id\tsparse\n"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # every row is 11 bytes, the chunk target is 40 bytes and at most 80 bytes of partial chunks are buffered
+        uploader = GroupedChunkUploader("project", "workspace", executor, ChunkSizer(40, min_bytes=1), max_uploads=1)
+        for header, rows in [(sparse_header, ROWS[:2]), (HEADER, ROWS[2:5]), (other_header, ROWS[5:8])]:
+            for row in rows:
+                uploader.add_row(header, row)
+        assert uploader.flush() == (8, 0)
+
+    # the 88 bytes buffered after the last row sent the largest partial chunk early, then flush sent the others
+    assert uploads == [(HEADER, 3), (sparse_header, 2), (other_header, 3)]
@@ -0,0 +1,25 @@
+from rewrite_data_model.rewrite_data_model_references import RewriteRules
+
+
+def test_literal_and_regex_rules_apply_in_a_single_pass():
+    rules = RewriteRules([("literal", "gs://old/", "gs://new/"), ("regex", r"drs://(\w+)/", r"drs://mirror/\1/")])
+    assert rules.rewrite("gs://old/a.bam drs://host/b") == "gs://new/a.bam drs://mirror/host/b"
+    # the output of one rule is not rewritten by another
+    assert RewriteRules([("literal", "a", "b"), ("literal", "b", "c")]).rewrite("ab") == "bc"
+
+
+def test_regex_rules_with_lookarounds():
+    rules = RewriteRules([("regex", "foo(?=bar)", "baz"), ("regex", r"(?<=gs://)old-(\w+)", r"new-\1")])
+    assert rules.rewrite("foobar foo") == "bazbar foo"
+    assert rules.rewrite("gs://old-bucket/x old-bucket") == "gs://new-bucket/x old-bucket"
+
+
+def test_rewrite_attribute_walks_json_objects_and_lists():
+    rules = RewriteRules([("literal", "gs://old/", "gs://new/")])
+    value = {"reads": ["gs://old/a.bam", {"index": "gs://old/a.bai", "size": 1}], "sample": {"entityType": "sample", "entityName": "gs://old/x"}}
+    assert rules.rewrite_attribute(value) == {"reads": ["gs://new/a.bam", {"index": "gs://new/a.bai", "size": 1}],
+                                              "sample": {"entityType": "sample", "entityName": "gs://old/x"}}
+    values = {"itemsType": "AttributeValue", "items": ["gs://old/a", 1]}
+    assert rules.rewrite_attribute(values) == {"itemsType": "AttributeValue", "items": ["gs://new/a", 1]}
+    references = {"itemsType": "EntityReference", "items": [{"entityType": "sample", "entityName": "gs://old/x"}]}
+    assert rules.rewrite_attribute(references) == references